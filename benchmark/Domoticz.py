@@ -0,0 +1,150 @@
+# Stand-in for the Domoticz Python plugin framework, just enough of it to run
+# plugin.py outside Domoticz. Log output is counted instead of written and
+# connections swallow everything which is sent to them.
+import time
+
+Devices = {}
+Parameters = {}
+Settings = {"SensorTimeout": "60"}
+
+counters = {"Debug": 0, "Log": 0, "Status": 0, "Error": 0, "Send": 0, "Update": 0}
+
+
+def Debug(msg):
+    counters["Debug"] += 1
+
+
+def Log(msg):
+    counters["Log"] += 1
+
+
+def Status(msg):
+    counters["Status"] += 1
+
+
+def Error(msg):
+    counters["Error"] += 1
+
+
+def Debugging(mask):
+    pass
+
+
+def Heartbeat(interval):
+    pass
+
+
+def reset(parameters):
+    Devices.clear()
+    Parameters.clear()
+    Parameters.update(parameters)
+    for key in counters:
+        counters[key] = 0
+
+
+class Connection:
+    def __init__(self, Name, Transport, Protocol, Address, Port):
+        self.Name = Name
+        self.Transport = Transport
+        self.Protocol = Protocol
+        self.Address = Address
+        self.Port = Port
+        self.connected = False
+
+    def __str__(self):
+        return self.Name
+
+    def Connect(self):
+        self.connected = True
+
+    def Connecting(self):
+        return False
+
+    def Connected(self):
+        return self.connected
+
+    def Disconnect(self):
+        self.connected = False
+
+    def Send(self, Data):
+        counters["Send"] += 1
+
+
+# Domoticz type and subtype for the TypeNames used by plugin.py
+TYPENAMES = {
+    "Switch": (0xF4, 0x49),
+    "Custom": (0xF3, 0x1F),
+    "Temperature": (0x50, 0x05),
+    "Humidity": (0x51, 0x01),
+    "Temp+Hum": (0x52, 0x01),
+    "Temp+Hum+Baro": (0x54, 0x10),
+}
+
+# Update() keyword arguments and the device attributes they set
+UPDATE_ATTRIBUTES = {
+    "Type": "Type",
+    "Subtype": "SubType",
+    "Switchtype": "SwitchType",
+    "Options": "Options",
+    "TimedOut": "TimedOut",
+    "Color": "Color",
+    "BatteryLevel": "BatteryLevel",
+    "SignalLevel": "SignalLevel",
+    "Description": "Description",
+    "Name": "Name",
+}
+
+
+class Device:
+    def __init__(
+        self,
+        Name,
+        Unit,
+        TypeName="",
+        Type=0,
+        Subtype=0,
+        Switchtype=0,
+        Options=None,
+        Used=0,
+        **kwargs
+    ):
+        self.Name = Name
+        self.Unit = Unit
+        self.ID = Unit
+        self.DeviceID = str(Unit)
+        self.Type, self.SubType = TYPENAMES.get(TypeName, (Type, Subtype))
+        self.SwitchType = Switchtype
+        self.Options = dict(Options or {})
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.LastLevel = 0
+        self.Color = ""
+        self.TimedOut = 0
+        self.BatteryLevel = 255
+        self.SignalLevel = 12
+        self.Description = ""
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
+
+    def __str__(self):
+        return "Unit: %d, Name: '%s', nValue: %d, sValue: '%s'" % (
+            self.Unit,
+            self.Name,
+            self.nValue,
+            self.sValue,
+        )
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+    def Update(self, nValue, sValue, **kwargs):
+        counters["Update"] += 1
+        self.nValue = nValue
+        self.sValue = sValue
+        for key, value in kwargs.items():
+            if key in UPDATE_ATTRIBUTES:
+                setattr(self, UPDATE_ATTRIBUTES[key], value)
+        self.LastUpdate = time.strftime("%Y-%m-%d %H:%M:%S")
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# Offline benchmark for plugin.py, runs the plugin against the stand-in
+# Domoticz module in this directory with synthetic Tasmota fleets.
+#
+# Usage: python3 benchmark/benchmark.py [--sizes 100,1000] [--plugin path]
+#
+# Every fleet size is run twice: once for timing and once under tracemalloc
+# for the memory figures, so tracing does not distort the latencies.
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Domoticz
+
+PARAMETERS = {
+    "Address": "127.0.0.1",
+    "Port": "1883",
+    "Mode1": "",
+    "Mode2": "homeassistant",
+    "Mode3": "",
+    "Mode4": "tasmota/sonoff/",
+    "Mode5": "",
+    "Mode6": "Normal",
+    "Key": "MQTTDiscovery",
+    "HardwareID": 1,
+    "HomeFolder": "",
+}
+
+# Every Tasmota node in the fleet has a relay, a dimmer and a temperature sensor
+DEVICES_PER_NODE = 3
+
+
+def loadPlugin(path):
+    # Load a fresh copy so module level caches do not leak between runs
+    spec = importlib.util.spec_from_file_location("plugin", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.Devices = Domoticz.Devices
+    module.Parameters = Domoticz.Parameters
+    module.Settings = Domoticz.Settings
+    return module
+
+
+def nodeTopic(node):
+    return "tasmota/node%05d/" % node
+
+
+def makeFleet(size):
+    # List of (devicename, devicetype, config) as onMQTTPublish would pass
+    # them to updateDeviceSettings, with abbreviations and '~' expanded
+    fleet = []
+    for i in range(size):
+        node = i // DEVICES_PER_NODE
+        base = nodeTopic(node)
+        nodeid = "%06X" % node
+        config = {
+            "availability_topic": base + "tele/LWT",
+            "payload_available": "Online",
+            "payload_not_available": "Offline",
+            "device": {"identifiers": [nodeid], "name": "node%d" % node},
+        }
+        role = i % DEVICES_PER_NODE
+        if role == 0:
+            devicetype = "switch"
+            devicename = nodeid + "_RL_1"
+            config.update(
+                {
+                    "name": "relay %d" % node,
+                    "command_topic": base + "cmnd/POWER1",
+                    "state_topic": base + "tele/STATE",
+                    "value_template": "{{value_json.POWER1}}",
+                    "payload_off": "OFF",
+                    "payload_on": "ON",
+                }
+            )
+        elif role == 1:
+            devicetype = "light"
+            devicename = nodeid + "_LI_2"
+            config.update(
+                {
+                    "name": "dimmer %d" % node,
+                    "command_topic": base + "cmnd/POWER2",
+                    "state_topic": base + "tele/STATE",
+                    "value_template": "{{value_json.POWER2}}",
+                    "payload_off": "OFF",
+                    "payload_on": "ON",
+                    "brightness_command_topic": base + "cmnd/Dimmer",
+                    "brightness_state_topic": base + "tele/STATE",
+                    "brightness_scale": 100,
+                    "brightness_value_template": "{{value_json.Dimmer}}",
+                }
+            )
+        else:
+            devicetype = "sensor"
+            devicename = nodeid + "_AM2301_Temperature"
+            config.update(
+                {
+                    "name": "temperature %d" % node,
+                    "state_topic": base + "tele/SENSOR",
+                    "device_class": "temperature",
+                    "unit_of_measurement": "C",
+                    "value_template": "{{value_json.AM2301.Temperature}}",
+                }
+            )
+        config["unique_id"] = devicename
+        fleet.append((devicename, devicetype, json.dumps(config)))
+    return fleet
+
+
+def makeMessages(size, count):
+    # Round robin over the nodes, alternating the payloads so that the
+    # devices actually change state
+    nodes = max(1, (size + DEVICES_PER_NODE - 1) // DEVICES_PER_NODE)
+    messages = []
+    for i in range(count):
+        node = (i // 3) % nodes
+        flip = (i // (3 * nodes)) % 2
+        base = nodeTopic(node)
+        kind = i % 3
+        if kind == 0:
+            payload = {
+                "POWER1": "ON" if flip else "OFF",
+                "POWER2": "OFF" if flip else "ON",
+                "Dimmer": 40 if flip else 60,
+                "Wifi": {"RSSI": 76, "Signal": -62},
+            }
+            messages.append((base + "tele/STATE", json.dumps(payload).encode()))
+        elif kind == 1:
+            payload = {
+                "Time": "2020-01-01T00:00:00",
+                "AM2301": {"Temperature": 21.5 + flip, "Humidity": 40.2},
+                "TempUnit": "C",
+            }
+            messages.append((base + "tele/SENSOR", json.dumps(payload).encode()))
+        else:
+            messages.append((base + "tele/LWT", b"Online"))
+    return messages
+
+
+def makeCommands(count):
+    # Commands for the relays and dimmers, addressed by the unit they got
+    switches = []
+    for unit, device in Domoticz.Devices.items():
+        if device.Type == 0xF4:
+            switches.append((unit, device.SwitchType))
+    commands = []
+    for i in range(count if switches else 0):
+        unit, switchtype = switches[i % len(switches)]
+        if switchtype == 7:
+            commands.append((unit, "Set Level", (i * 7) % 100, ""))
+        else:
+            commands.append((unit, "On" if i % 2 else "Off", 0, ""))
+    return commands
+
+
+class Phase:
+    def __init__(self, name):
+        self.name = name
+        self.latencies = []
+        self.elapsed = 0
+        self.peak = None
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0
+        index = min(len(self.latencies) - 1, int(len(self.latencies) * fraction))
+        return self.latencies[index] / 1000  # us
+
+    def row(self):
+        self.latencies.sort()
+        calls = len(self.latencies)
+        rate = calls / self.elapsed if self.elapsed > 0 else 0
+        peak = "-" if self.peak is None else "%.1f" % (self.peak / 1048576)
+        return "%-18s %7d %11.0f %9.1f %9.1f %9.1f %10.1f %9s" % (
+            self.name,
+            calls,
+            rate,
+            self.percentile(0.5),
+            self.percentile(0.9),
+            self.percentile(0.99),
+            self.latencies[-1] / 1000 if calls else 0,
+            peak,
+        )
+
+
+def timeCalls(phase, func, calls, traced):
+    if traced:
+        tracemalloc.reset_peak()
+    latencies = phase.latencies
+    clock = time.perf_counter_ns
+    start = clock()
+    for args in calls:
+        before = clock()
+        func(*args)
+        latencies.append(clock() - before)
+    phase.elapsed = (clock() - start) / 1e9
+    if traced:
+        phase.peak = tracemalloc.get_traced_memory()[1]
+
+
+def run(path, size, args, traced):
+    # Every run gets an empty plugin folder, so it never warm starts from
+    # the snapshot saved by an earlier run
+    with tempfile.TemporaryDirectory() as folder:
+        module = loadPlugin(path)
+        Domoticz.reset(dict(PARAMETERS, HomeFolder=folder + os.sep))
+        fleet = makeFleet(size)
+        messages = makeMessages(size, args.messages)
+
+        if traced:
+            tracemalloc.start()
+        plugin = module.BasePlugin()
+        plugin.onStart()
+        client = plugin.mqttClient
+        client.onConnect(client.mqttConn, 0, "")
+        client.onMessage(client.mqttConn, {"Verb": "CONNACK"})
+
+        phases = []
+        # The configs are decoded beforehand, updateDeviceSettings modifies them
+        phase = Phase("discovery new")
+        configs = [(name, kind, json.loads(config)) for name, kind, config in fleet]
+        timeCalls(phase, plugin.updateDeviceSettings, configs, traced)
+        phases.append(phase)
+
+        phase = Phase("discovery known")
+        configs = [(name, kind, json.loads(config)) for name, kind, config in fleet]
+        timeCalls(phase, plugin.updateDeviceSettings, configs, traced)
+        phases.append(phase)
+
+        phase = Phase("onMQTTPublish")
+        timeCalls(phase, plugin.onMQTTPublish, messages, traced)
+        phases.append(phase)
+
+        phase = Phase("onCommand")
+        timeCalls(phase, plugin.onCommand, makeCommands(args.commands), traced)
+        phases.append(phase)
+
+        phase = Phase("onHeartbeat")
+        timeCalls(phase, plugin.onHeartbeat, [()] * args.heartbeats, traced)
+        phases.append(phase)
+
+        if traced:
+            tracemalloc.stop()
+        return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark for plugin.py")
+    parser.add_argument(
+        "--plugin",
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "..", "plugin.py"
+        ),
+        help="plugin.py to measure, e.g. an older revision to compare against",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="100,1000,10000",
+        help="comma separated fleet sizes (devices)",
+    )
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--commands", type=int, default=2000)
+    parser.add_argument("--heartbeats", type=int, default=100)
+    parser.add_argument(
+        "--no-memory",
+        dest="memory",
+        action="store_false",
+        help="skip the tracemalloc pass",
+    )
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.plugin)
+    print("Plugin: %s" % path)
+    print("Python: %s" % sys.version.split()[0])
+    for size in [int(s) for s in args.sizes.split(",") if s]:
+        phases = run(path, size, args, False)
+        if args.memory:
+            for phase, traced in zip(phases, run(path, size, args, True)):
+                phase.peak = traced.peak
+        print()
+        print("Fleet of %d devices" % size)
+        print(
+            "%-18s %7s %11s %9s %9s %9s %10s %9s"
+            % (
+                "phase",
+                "calls",
+                "calls/s",
+                "p50 us",
+                "p90 us",
+                "p99 us",
+                "max us",
+                "peak MiB",
+            )
+        )
+        for phase in phases:
+            print(phase.row())
+        print(
+            "Domoticz calls: %s"
+            % ", ".join("%s=%d" % item for item in sorted(Domoticz.counters.items()))
+        )
+
+
+if __name__ == "__main__":
+    main()
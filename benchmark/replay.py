@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# Replays an MQTT recording, made with the plugin's "recordFile" option,
+# through BasePlugin.onMQTTPublish using the stand-in Domoticz module.
+#
+# Usage: python3 benchmark/replay.py recording.bin [--speed 1] [--plugin path]
+#
+# The recording is replayed at recorded speed, at N times recorded speed or,
+# with --speed 0, as fast as possible. The plugin sees the recorded time as
+# its clock and onHeartbeat is called every 10 s of recorded time, as Domoticz
+# would, so time outs and discovery buffering behave as they did when recorded.
+# Discovery configs still buffered at the end are processed by a final
+# heartbeat.
+import argparse
+import heapq
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import Domoticz
+from benchmark import PARAMETERS, Phase, loadPlugin
+
+HEARTBEAT_INTERVAL = 10
+
+PLUGIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "plugin.py")
+
+
+class RecordedClock:
+    # Replacement for the time module which reports the recorded time
+    def __init__(self):
+        self.now = time.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def time(self):
+        return self.now
+
+    def localtime(self, secs=None):
+        return time.localtime(self.now if secs is None else secs)
+
+    def strftime(self, format, t=None):
+        return time.strftime(format, self.localtime() if t is None else t)
+
+
+def topicKind(topic):
+    # Last topic level without node specific parts, e.g. STATE or config
+    return topic.rsplit("/", 1)[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an MQTT recording")
+    parser.add_argument("recording", help="file written by the recordFile option")
+    parser.add_argument(
+        "--plugin",
+        default=PLUGIN,
+        help="plugin.py to replay against, e.g. an older revision",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="multiple of recorded speed, 0 for as fast as possible",
+    )
+    parser.add_argument("--options", default="", help="plugin options (Mode3) JSON")
+    parser.add_argument("--top", type=int, default=10, help="expensive messages shown")
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.plugin)
+    # The recording format is the one of this tree, also for older revisions
+    recorder = loadPlugin(PLUGIN).MqttRecorder
+    module = loadPlugin(path)
+    clock = RecordedClock()
+    module.time = clock
+    Domoticz.time = clock
+    # An empty plugin folder, so the replay never warm starts from a snapshot
+    folder = tempfile.TemporaryDirectory()
+    Domoticz.reset(
+        dict(PARAMETERS, Mode3=args.options, HomeFolder=folder.name + os.sep)
+    )
+
+    plugin = module.BasePlugin()
+    plugin.onStart()
+    client = plugin.mqttClient
+    client.onConnect(client.mqttConn, 0, "")
+    client.onMessage(client.mqttConn, {"Verb": "CONNACK"})
+
+    publish = Phase("onMQTTPublish")
+    heartbeat = Phase("onHeartbeat")
+    kinds = {}  # topic kind -> [count, total ns, max ns]
+    slowest = []  # min-heap of (ns, index, topic, payload)
+    counter = time.perf_counter_ns
+    first = None
+    nextHeartbeat = None
+    start = counter()
+    for index, (timestamp, topic, payload, retain) in enumerate(
+        recorder.read(args.recording)
+    ):
+        if first is None:
+            first = timestamp
+            nextHeartbeat = timestamp + HEARTBEAT_INTERVAL
+            clock.now = timestamp
+        if args.speed > 0:
+            delay = (timestamp - first) / args.speed - (counter() - start) / 1e9
+            if delay > 0:
+                time.sleep(delay)
+        while timestamp >= nextHeartbeat:
+            clock.now = nextHeartbeat
+            before = counter()
+            plugin.onHeartbeat()
+            heartbeat.latencies.append(counter() - before)
+            nextHeartbeat += HEARTBEAT_INTERVAL
+
+        clock.now = timestamp
+        before = counter()
+        plugin.onMQTTPublish(topic, payload)
+        latency = counter() - before
+        publish.latencies.append(latency)
+
+        kind = kinds.get(topicKind(topic))
+        if kind is None:
+            kind = kinds[topicKind(topic)] = [0, 0, 0]
+        kind[0] += 1
+        kind[1] += latency
+        kind[2] = max(kind[2], latency)
+        entry = (latency, index, topic, payload)
+        if len(slowest) < args.top:
+            heapq.heappush(slowest, entry)
+        elif latency > slowest[0][0]:
+            heapq.heapreplace(slowest, entry)
+    if first is not None:
+        # Process the discovery configs still buffered and the updates still
+        # held back, a short recording may not reach the end of the burst
+        clock.now = timestamp + HEARTBEAT_INTERVAL
+        before = counter()
+        if getattr(plugin, "discoveryBurst", None) is not None:
+            plugin.flushDiscovery()
+        plugin.onHeartbeat()
+        heartbeat.latencies.append(counter() - before)
+    elapsed = (counter() - start) / 1e9
+    publish.elapsed = elapsed
+    heartbeat.elapsed = elapsed
+
+    print("Plugin: %s" % path)
+    print("Recording: %s, speed: %s" % (args.recording, args.speed or "max"))
+    print("Replayed %d messages in %.2f s" % (len(publish.latencies), elapsed))
+    print()
+    print(
+        "%-18s %7s %11s %9s %9s %9s %10s %9s"
+        % ("phase", "calls", "calls/s", "p50 us", "p90 us", "p99 us", "max us", "")
+    )
+    print(publish.row())
+    print(heartbeat.row())
+    print()
+    print(
+        "%-24s %7s %12s %10s %10s"
+        % ("topic kind", "count", "total ms", "mean us", "max us")
+    )
+    for name, (count, total, longest) in sorted(
+        kinds.items(), key=lambda item: item[1][1], reverse=True
+    ):
+        print(
+            "%-24s %7d %12.1f %10.1f %10.1f"
+            % (name[:24], count, total / 1e6, total / count / 1000, longest / 1000)
+        )
+    print()
+    print("Slowest messages:")
+    for latency, index, topic, payload in sorted(slowest, reverse=True):
+        print("%10.1f us #%d %s %s" % (latency / 1000, index, topic, payload[:60]))
+    print(
+        "Domoticz calls: %s"
+        % ", ".join("%s=%d" % item for item in sorted(Domoticz.counters.items()))
+    )
+
+
+if __name__ == "__main__":
+    main()
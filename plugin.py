@@ -9,7 +9,7 @@
       Automatically creates Domoticz device entries for all discovered devices.<br/>
     </description>
     <params>
-        <param field="Address" label="MQTT Server address" width="300px" required="true" default="127.0.0.1"/>
+        <param field="Address" label="MQTT Server address (fallbacks comma separated)" width="300px" required="true" default="127.0.0.1"/>
         <param field="Port" label="Port" width="300px" required="true" default="1883"/>
         <!-- <param field="Mode5" label="MQTT QoS" width="300px" default="0"/> -->
         <param field="Username" label="Username" width="300px"/>
@@ -17,7 +17,7 @@
         <!-- <param field="Mode1" label="CA Filename" width="300px"/> -->
 
         <param field="Mode2" label="Discovery topic" width="300px" default="homeassistant"/>
-        <param field="Mode4" label="Ignored device topics (comma separated)" width="300px" default="tasmota/sonoff/"/>
+        <param field="Mode4" label="Ignored device topics (comma separated, MQTT + and # wildcards allowed)" width="300px" default="tasmota/sonoff/"/>
 
         <param field="Mode3" label="Options" width="300px"/>
         <param field="Mode6" label="Debug" width="75px">
@@ -36,11 +36,271 @@ import Domoticz
 # from Domoticz import Devices # Used for local debugging without Domoticz
 # from Domoticz import Settings # Used for local debugging without Domoticz
 from datetime import datetime
-from itertools import count, filterfalse
+import bisect
+import hashlib
+import heapq
 import json
+import os
+import random
 import re
+import struct
+import sys
 import time
-import traceback
+
+# Maximum number of topics sent in a single SUBSCRIBE or UNSUBSCRIBE packet
+MQTT_MAX_TOPICS_PER_PACKET = 50
+
+# Maximum number of seconds discovery configs are buffered after (re)connect
+DISCOVERY_BURST_MAX_DURATION = 60
+
+# Seconds between onHeartbeat calls
+HEARTBEAT_INTERVAL = 10
+
+# Initial reconnect delay, doubled after every failed attempt
+RECONNECT_MIN_DELAY = 10
+
+# Seconds to wait for CONNACK after starting a connection attempt
+CONNECT_TIMEOUT = 30
+
+# Seconds over which per device / topic log lines are rate limited
+LOG_RATE_INTERVAL = 60
+
+# Format of the warm start snapshot, increase when DeviceDescriptor changes
+SNAPSHOT_VERSION = 4
+
+# Discovery components handled by updateDeviceSettings, subscribed to below
+# the discovery topic
+DISCOVERY_COMPONENTS = ("binary_sensor", "cover", "light", "sensor", "switch")
+
+
+class PluginLogger:
+    # Logging gated by the Mode6 debug level. Messages are passed as format
+    # string and arguments and only formatted when they are actually emitted.
+    def __init__(self):
+        self.debugging = False
+        self.verbose = False  # Dump MQTT messages
+        self.rateLimit = 0  # Max lines per key per LOG_RATE_INTERVAL, 0 = no limit
+        self.summaryInterval = 0  # Seconds between summary lines, 0 = no summaries
+        self.windowStart = time.time()
+        self.counters = {}  # (category, keyname) -> [count, keys]
+        self.rateCounts = {}
+        self.suppressed = 0
+
+    def configure(self, debugging, rateLimit=0, summaryInterval=0):
+        self.debugging = debugging != "Normal"
+        self.verbose = debugging == "Verbose" or debugging == "Verbose+"
+        self.rateLimit = rateLimit
+        self.summaryInterval = summaryInterval
+
+    def debug(self, msg, *args):
+        if self.debugging:
+            Domoticz.Debug(msg % args if args else msg)
+
+    # Per message log line about key (a unit or topic). Counted into a summary
+    # line if summaries are enabled, otherwise rate limited per key.
+    def event(self, category, keyname, key, msg, *args):
+        if self.summaryInterval > 0:
+            counter = self.counters.get((category, keyname))
+            if counter is None:
+                counter = self.counters[(category, keyname)] = [0, set()]
+            counter[0] += 1
+            counter[1].add(key)
+            self.debug(msg, *args)
+            return
+        if self.rateLimit > 0:
+            count = self.rateCounts.get(key, 0) + 1
+            self.rateCounts[key] = count
+            if count > self.rateLimit:
+                self.suppressed += 1
+                return
+        Domoticz.Log(msg % args if args else msg)
+
+    # Emit summary lines and start a new rate limit window when due
+    def onHeartbeat(self, now):
+        interval = self.summaryInterval
+        if interval <= 0:
+            interval = LOG_RATE_INTERVAL
+        elapsed = now - self.windowStart
+        if elapsed < interval:
+            return
+        for (category, keyname), (count, keys) in self.counters.items():
+            Domoticz.Log(
+                "%d %s on %d %s in the last %d s"
+                % (count, category, len(keys), keyname, elapsed)
+            )
+        if self.suppressed > 0:
+            Domoticz.Log(
+                "%d log lines suppressed in the last %d s" % (self.suppressed, elapsed)
+            )
+        self.windowStart = now
+        self.counters = {}
+        self.rateCounts = {}
+        self.suppressed = 0
+
+
+logger = PluginLogger()
+
+
+class PluginMetrics:
+    # Counters and latency histograms of the plugin, collected per reporting
+    # interval. Timings are only taken when enabled.
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 100)  # Histogram limits, ms
+
+    def __init__(self):
+        self.enabled = False
+        self.reset(time.time())
+
+    def reset(self, now):
+        self.windowStart = now
+        self.counters = {}
+        self.timers = {}  # name -> [count, total ms, max ms, bucket counts]
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def timing(self, name, seconds):
+        ms = seconds * 1000
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = [0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+        timer[0] += 1
+        timer[1] += ms
+        timer[2] = max(timer[2], ms)
+        timer[3][bisect.bisect_left(self.BUCKETS, ms)] += 1
+
+    # Returns the statistics of the interval since the last snapshot and
+    # starts a new interval
+    def snapshot(self, now, gauges):
+        elapsed = max(now - self.windowStart, 0.001)
+        timers = {}
+        for name, (count, total, longest, buckets) in self.timers.items():
+            histogram = {}
+            for limit, bucket in zip(self.BUCKETS + ("inf",), buckets):
+                histogram[str(limit)] = bucket
+            timers[name] = {
+                "count": count,
+                "mean_ms": round(total / count, 3),
+                "max_ms": round(longest, 3),
+                "histogram_ms": histogram,
+            }
+        stats = {
+            "interval": round(elapsed, 1),
+            "counters": self.counters,
+            "rates": {
+                name: round(count / elapsed, 2) for name, count in self.counters.items()
+            },
+            "timers": timers,
+            "gauges": gauges,
+        }
+        self.reset(now)
+        return stats
+
+
+metrics = PluginMetrics()
+
+# Statistics shown as Custom sensor devices when enabled: Options["statsname"],
+# device name, axis label and the path of the value in the statistics
+STATS_DEVICES = (
+    ("messages_in", "Messages in", "msg/s", ("rates", "messagesIn")),
+    ("messages_out", "Messages out", "msg/s", ("rates", "messagesOut")),
+    ("device_writes", "Device writes", "writes/s", ("rates", "deviceWrites")),
+    ("message_time", "Message handling time", "ms", ("timers", "message", "mean_ms")),
+    ("publish_queue", "Publish queue", "messages", ("gauges", "publishQueue")),
+    ("subscriptions", "Subscriptions", "topics", ("gauges", "subscriptions")),
+)
+
+
+class LazyStr:
+    # Defers an expensive str() conversion of a log argument until the
+    # message is actually formatted
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+
+# First bytes of JSON documents, other payloads are not tried as JSON
+JSON_START_BYTES = frozenset(b'{["-0123456789tfn')
+
+
+class MqttPayload:
+    # Payload of a received message, decoded to text and JSON on first use
+    __slots__ = ("raw", "decodedText", "decodedValue", "decoded")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.decodedText = None
+        self.decodedValue = None
+        self.decoded = False
+
+    @property
+    def text(self):
+        if self.decodedText is None:
+            self.decodedText = self.raw.decode("utf8", "replace")
+        return self.decodedText
+
+    # Decoded JSON, the text if the payload is not JSON
+    @property
+    def value(self):
+        if not self.decoded:
+            self.decoded = True
+            self.decodedValue = self.text
+            stripped = self.raw.lstrip(b" \t\r\n")
+            if stripped and stripped[0] in JSON_START_BYTES:
+                try:
+                    self.decodedValue = json.loads(self.decodedText)
+                except ValueError:
+                    metrics.count("jsonDecodeFailures")
+        return self.decodedValue
+
+
+class MqttRecorder:
+    # Records received PUBLISH messages to a file for replaying them later.
+    # After the MAGIC header every record is a RECORD header (arrival time,
+    # retain flag, topic length, payload length) followed by topic and payload.
+    MAGIC = b"MQTTREC1"
+    RECORD = struct.Struct("<dBHI")
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(self.MAGIC)
+        self.count = 0
+
+    def record(self, topic, payload, retain):
+        topic = topic.encode("utf-8")
+        self.file.write(
+            self.RECORD.pack(time.time(), 1 if retain else 0, len(topic), len(payload))
+        )
+        self.file.write(topic)
+        self.file.write(payload)
+        self.count += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    # Yields (timestamp, topic, payload, retain) for every record in path
+    @classmethod
+    def read(cls, path):
+        with open(path, "rb") as file:
+            if file.read(len(cls.MAGIC)) != cls.MAGIC:
+                raise ValueError("Not an MQTT recording: " + path)
+            while True:
+                header = file.read(cls.RECORD.size)
+                if len(header) < cls.RECORD.size:
+                    return
+                timestamp, retain, topiclen, payloadlen = cls.RECORD.unpack(header)
+                topic = file.read(topiclen).decode("utf-8")
+                payload = file.read(payloadlen)
+                if len(payload) < payloadlen:
+                    return  # Truncated last record
+                yield timestamp, topic, payload, retain == 1
 
 
 class MqttClient:
@@ -60,14 +320,58 @@ class MqttClient:
         mqttDisconnectedCb,
         mqttPublishCb,
         mqttSubackCb,
+        queueSize=100,
+        queueMaxAge=60,
+        reconnectMaxDelay=300,
+        keepAlive=60,
+        pingTimeout=30,
     ):
         Domoticz.Debug("MqttClient::__init__")
-        self.Address = destination
-        self.Port = port
+        # Broker addresses, comma separated 'address' or 'address:port', IPv6
+        # literals as '[address]:port'. On failure the next one is tried.
+        self.brokers = []
+        for broker in destination.split(","):
+            if broker:
+                self.brokers.append(self.parseBroker(broker, port))
+        self.brokerIndex = 0
+        self.Address, self.Port = self.brokers[0]
+        # Connection state: "connecting" from Open() until CONNACK, then
+        # "connected". "waiting" until the next attempt at nextConnect.
+        self.state = "waiting"
+        self.connectStarted = 0
+        self.nextConnect = 0
+        self.reconnectDelay = 0
+        self.reconnectMaxDelay = reconnectMaxDelay
+        # Link supervision: PING after keepAlive seconds without traffic in
+        # either direction, reconnect if nothing is received pingTimeout
+        # seconds after it
+        self.keepAlive = keepAlive
+        self.pingTimeout = pingTimeout
+        self.lastReceived = 0
+        self.lastSent = 0
+        self.pingSent = None
+        self.pingCount = 0
+        self.stallCount = 0
+        self.rtt = None  # Seconds between last PING and its PINGRESP
         self.mqttConnectedCb = mqttConnectedCb
         self.mqttDisconnectedCb = mqttDisconnectedCb
         self.mqttPublishCb = mqttPublishCb
         self.mqttSubackCb = mqttSubackCb
+        self.subscriptions = set()  # Topics which should be subscribed
+        self.pendingSubacks = 0
+        self.recorder = None  # MqttRecorder for received messages
+        # Messages published while disconnected, sent after CONNACK.
+        # key -> (time queued, topic, payload, retain)
+        self.queue = {}
+        self.queueSize = queueSize  # Max queued messages, oldest dropped first
+        self.queueMaxAge = queueMaxAge  # Seconds after which queued messages expire
+        self.queueStats = {
+            "queued": 0,
+            "coalesced": 0,
+            "dropped": 0,
+            "expired": 0,
+            "peak": 0,
+        }
         self.Open()
 
     def __str__(self):
@@ -82,6 +386,12 @@ class MqttClient:
         if self.mqttConn != None:
             self.Close()
         self.isConnected = False
+        self.state = "connecting"
+        self.connectStarted = time.time()
+        self.lastReceived = self.connectStarted
+        self.lastSent = self.connectStarted
+        self.pingSent = None
+        self.Address, self.Port = self.brokers[self.brokerIndex]
         self.mqttConn = Domoticz.Connection(
             Name=self.Address,
             Transport="TCP/IP",
@@ -105,45 +415,183 @@ class MqttClient:
                 + str(int(time.time()))
             )
             Domoticz.Log("MQTT CONNECT ID: '" + ID + "'")
-            self.mqttConn.Send({"Verb": "CONNECT", "ID": ID})
+            self.send({"Verb": "CONNECT", "ID": ID})
 
     def Ping(self):
-        Domoticz.Debug("MqttClient::Ping")
-        if self.mqttConn == None or not self.isConnected:
-            self.Open()
-        else:
-            self.mqttConn.Send({"Verb": "PING"})
+        logger.debug("MqttClient::Ping")
+        if self.mqttConn != None and self.isConnected:
+            self.pingSent = time.time()
+            self.pingCount += 1
+            self.send({"Verb": "PING"})
+
+    def send(self, Data):
+        self.lastSent = time.time()
+        self.mqttConn.Send(Data)
+
+    # Publish payload, queued until connected if the connection is down. A
+    # queued message replaces an earlier queued one for the same topic unless
+    # coalesce is False, e.g. for requests which differ in payload only.
+    def Publish(self, topic, payload, retain=0, coalesce=True):
+        logger.event(
+            "publishes", "topics", topic, "MqttClient::Publish %s (%s)", topic, payload
+        )
+        if self.mqttConn != None and self.isConnected:
+            self.sendPublish(topic, payload, retain)
+            return
+        key = topic if coalesce else (topic, payload)
+        if self.queue.pop(key, None) is not None:
+            self.queueStats["coalesced"] += 1
+        elif len(self.queue) >= self.queueSize:
+            del self.queue[next(iter(self.queue))]
+            self.queueStats["dropped"] += 1
+        self.queue[key] = (time.time(), topic, payload, retain)
+        self.queueStats["queued"] += 1
+        self.queueStats["peak"] = max(self.queueStats["peak"], len(self.queue))
+
+    def sendPublish(self, topic, payload, retain):
+        metrics.count("messagesOut")
+        self.send(
+            {
+                "Verb": "PUBLISH",
+                "Topic": topic,
+                "Payload": bytearray(payload, "utf-8"),
+                "Retain": retain,
+            }
+        )
 
-    def Publish(self, topic, payload, retain=0):
-        Domoticz.Log("MqttClient::Publish " + topic + " (" + payload + ")")
-        if self.mqttConn == None or not self.isConnected:
-            self.Open()
-        else:
-            self.mqttConn.Send(
-                {
-                    "Verb": "PUBLISH",
-                    "Topic": topic,
-                    "Payload": bytearray(payload, "utf-8"),
-                    "Retain": retain,
-                }
-            )
+    # Send the messages queued while disconnected in order, except expired ones
+    def flushQueue(self):
+        if not self.queue:
+            return
+        expiry = time.time() - self.queueMaxAge
+        queue = self.queue
+        self.queue = {}
+        sent = 0
+        for queued, topic, payload, retain in queue.values():
+            if queued < expiry:
+                self.queueStats["expired"] += 1
+            else:
+                self.sendPublish(topic, payload, retain)
+                sent += 1
+        Domoticz.Log(
+            "MqttClient: Sent %d queued messages, %d expired"
+            % (sent, len(queue) - sent)
+        )
 
+    # Queue depth and counters since start
+    def getQueueMetrics(self):
+        metrics = dict(self.queueStats)
+        metrics["depth"] = len(self.queue)
+        return metrics
+
+    # Subscribe to the topics which are not already subscribed
     def Subscribe(self, topics):
-        Domoticz.Debug("MqttClient::Subscribe")
-        subscriptionlist = []
+        logger.debug("MqttClient::Subscribe")
+        newtopics = []
         for topic in topics:
-            subscriptionlist.append({"Topic": topic, "QoS": 0})
-        if self.mqttConn == None or not self.isConnected:
-            self.Open()
-        else:
-            self.mqttConn.Send({"Verb": "SUBSCRIBE", "Topics": subscriptionlist})
+            if topic not in self.subscriptions:
+                self.subscriptions.add(topic)
+                newtopics.append(topic)
+        # Otherwise all subscriptions are sent after CONNACK
+        if self.mqttConn != None and self.isConnected:
+            self.sendSubscribe(newtopics)
+
+    # Unsubscribe from the topics which are currently subscribed
+    def Unsubscribe(self, topics):
+        logger.debug("MqttClient::Unsubscribe")
+        oldtopics = []
+        for topic in topics:
+            if topic in self.subscriptions:
+                self.subscriptions.discard(topic)
+                oldtopics.append(topic)
+        if self.mqttConn != None and self.isConnected:
+            for i in range(0, len(oldtopics), MQTT_MAX_TOPICS_PER_PACKET):
+                self.send(
+                    {
+                        "Verb": "UNSUBSCRIBE",
+                        "Topics": oldtopics[i : i + MQTT_MAX_TOPICS_PER_PACKET],
+                    }
+                )
+
+    def sendSubscribe(self, topics):
+        topics = list(topics)
+        for i in range(0, len(topics), MQTT_MAX_TOPICS_PER_PACKET):
+            subscriptionlist = []
+            for topic in topics[i : i + MQTT_MAX_TOPICS_PER_PACKET]:
+                subscriptionlist.append({"Topic": topic, "QoS": 0})
+            self.pendingSubacks += 1
+            self.send({"Verb": "SUBSCRIBE", "Topics": subscriptionlist})
 
     def Close(self):
         Domoticz.Log("MqttClient::Close")
-        # TODO: Disconnect from server
+        if self.mqttConn != None and (
+            self.mqttConn.Connected() or self.mqttConn.Connecting()
+        ):
+            self.mqttConn.Disconnect()
         self.mqttConn = None
         self.isConnected = False
 
+    # Split 'address[:port]', a bare IPv6 literal has no port
+    @staticmethod
+    def parseBroker(broker, port):
+        if broker.startswith("["):
+            address, _, rest = broker[1:].partition("]")
+            return (address, rest[1:] if rest.startswith(":") else port)
+        if broker.count(":") == 1:
+            address, _, brokerport = broker.partition(":")
+            return (address, brokerport or port)
+        return (broker, port)
+
+    # Close the connection and schedule the next attempt after an
+    # exponentially growing delay with jitter. A failed attempt moves on to
+    # the next broker, a dropped session starts over with the primary.
+    def scheduleReconnect(self):
+        dropped = self.state == "connected"
+        self.Close()
+        self.state = "waiting"
+        self.reconnectDelay = min(
+            max(RECONNECT_MIN_DELAY, self.reconnectDelay * 2), self.reconnectMaxDelay
+        )
+        delay = random.uniform(self.reconnectDelay / 2, self.reconnectDelay)
+        self.nextConnect = time.time() + delay
+        if dropped:
+            self.brokerIndex = 0
+        else:
+            self.brokerIndex = (self.brokerIndex + 1) % len(self.brokers)
+        Domoticz.Log(
+            "MqttClient: Reconnecting to %s:%s in %d s"
+            % (self.brokers[self.brokerIndex] + (delay,))
+        )
+
+    # Drives connection attempts, called from the plugin heartbeat
+    def onHeartbeat(self, now):
+        if self.state == "waiting":
+            if now >= self.nextConnect:
+                logger.debug("Reconnecting")
+                self.Open()
+        elif self.state == "connecting":
+            if now - self.connectStarted >= CONNECT_TIMEOUT:
+                Domoticz.Log(
+                    "MqttClient: No CONNACK from %s:%s within %d s"
+                    % (self.Address, self.Port, CONNECT_TIMEOUT)
+                )
+                self.scheduleReconnect()
+        elif not self.mqttConn.Connected():
+            self.scheduleReconnect()
+        elif self.pingSent is not None and self.lastReceived < self.pingSent:
+            # Nothing received since the PING
+            if now - self.pingSent >= self.pingTimeout:
+                Domoticz.Log(
+                    "MqttClient: No response from %s:%s within %d s, reconnecting"
+                    % (self.Address, self.Port, self.pingTimeout)
+                )
+                self.stallCount += 1
+                self.scheduleReconnect()
+                if self.mqttDisconnectedCb != None:
+                    self.mqttDisconnectedCb()
+        elif now - min(self.lastReceived, self.lastSent) >= self.keepAlive:
+            self.Ping()
+
     def onConnect(self, Connection, Status, Description):
         Domoticz.Debug("MqttClient::onConnect")
         if Status == 0:
@@ -160,6 +608,7 @@ class MqttClient:
                 + ", Description: "
                 + Description
             )
+            self.scheduleReconnect()
 
     def onDisconnect(self, Connection):
         Domoticz.Log(
@@ -168,43 +617,65 @@ class MqttClient:
             + ":"
             + Connection.Port
         )
-        self.Close()
-        # TODO: Reconnect?
+        if self.state == "waiting":
+            return  # Closed by scheduleReconnect
+        self.scheduleReconnect()
         if self.mqttDisconnectedCb != None:
             self.mqttDisconnectedCb()
 
     def onMessage(self, Connection, Data):
+        self.lastReceived = time.time()
         topic = ""
         if "Topic" in Data:
             topic = Data["Topic"]
-        payloadStr = ""
-        if "Payload" in Data:
-            payloadStr = Data["Payload"].decode("utf8", "replace")
-            payloadStr = str(payloadStr.encode("unicode_escape"))
-        # Domoticz.Debug("MqttClient::onMessage called for connection: '"+Connection.Name+"' type:'"+Data['Verb']+"' topic:'"+topic+"' payload:'" + payloadStr + "'")
 
         if Data["Verb"] == "CONNACK":
             self.isConnected = True
+            self.state = "connected"
+            self.reconnectDelay = 0
+            # New session, restore all subscriptions
+            self.pendingSubacks = 0
+            self.sendSubscribe(self.subscriptions)
+            self.flushQueue()
             if self.mqttConnectedCb != None:
                 self.mqttConnectedCb()
 
+        if Data["Verb"] == "PINGRESP" and self.pingSent is not None:
+            self.rtt = self.lastReceived - self.pingSent
+            logger.debug("MqttClient: PINGRESP after %.3f s", self.rtt)
+
         if Data["Verb"] == "SUBACK":
-            if self.mqttSubackCb != None:
+            # Report once all outstanding SUBSCRIBE packets are acknowledged
+            self.pendingSubacks = max(0, self.pendingSubacks - 1)
+            if self.pendingSubacks == 0 and self.mqttSubackCb != None:
                 self.mqttSubackCb()
 
         if Data["Verb"] == "PUBLISH":
+            if self.recorder != None:
+                self.recorder.record(topic, Data["Payload"], Data.get("Retain", False))
+            metrics.count("messagesIn")
             if self.mqttPublishCb != None:
-                self.mqttPublishCb(topic, Data["Payload"])
+                if metrics.enabled:
+                    start = time.perf_counter()
+                    self.mqttPublishCb(topic, Data["Payload"])
+                    metrics.timing("message", time.perf_counter() - start)
+                else:
+                    self.mqttPublishCb(topic, Data["Payload"])
 
 
+CONF_AVAILABILITY = "availability"
 CONF_DEVICE = "device"
+CONF_TOPIC = "topic"
 TOPIC_BASE = "~"
 
 ABBREVIATIONS = {
     "aux_cmd_t": "aux_command_topic",
     "aux_stat_tpl": "aux_state_template",
     "aux_stat_t": "aux_state_topic",
+    "avty": "availability",
+    "avty_mode": "availability_mode",
     "avty_t": "availability_topic",
+    "avty_tpl": "availability_template",
     "away_mode_cmd_t": "away_mode_command_topic",
     "away_mode_stat_tpl": "away_mode_state_template",
     "away_mode_stat_t": "away_mode_state_topic",
@@ -335,38 +806,584 @@ DEVICE_ABBREVIATIONS = {
 }
 
 
+def expandTopic(value, base):
+    # Substitutes the topic base for a leading or trailing '~'
+    if base:
+        if value[0] == TOPIC_BASE:
+            value = base + value[1:]
+        if value[-1] == TOPIC_BASE:
+            value = value[:-1] + base
+    # Many devices share their topics, keep one copy of each
+    return sys.intern(value)
+
+
+def expandConfig(message):
+    # Returns the discovery config message with the abbreviations expanded,
+    # the '~' topic base substituted and the keys sorted, so equal configs
+    # are equal dicts which also serialize to the same JSON
+    base = message.get(TOPIC_BASE)
+    if base and not isinstance(base, str):
+        base = str(base)  # As format() did for a numeric '~'
+    items = []
+    for key, value in message.items():
+        if key == TOPIC_BASE:
+            continue
+        key = ABBREVIATIONS.get(key, key)
+        if isinstance(value, str) and value and key.endswith("_topic"):
+            value = expandTopic(value, base)
+        elif key == CONF_DEVICE and isinstance(value, dict):
+            value = sortedDict(
+                (DEVICE_ABBREVIATIONS.get(name, name), item)
+                for name, item in value.items()
+            )
+        elif key == CONF_AVAILABILITY and isinstance(value, list):
+            value = [expandAvailability(entry, base) for entry in value]
+        items.append((key, value))
+    return sortedDict(items)
+
+
+def expandAvailability(entry, base):
+    # Entry of an availability list, a dict with a topic and its payloads
+    if not isinstance(entry, dict):
+        return entry
+    items = []
+    for key, value in entry.items():
+        key = ABBREVIATIONS.get(key, key)
+        if key == CONF_TOPIC and isinstance(value, str) and value:
+            value = expandTopic(value, base)
+        items.append((key, value))
+    return sortedDict(items)
+
+
+def sortedDict(items):
+    # Later items win for duplicate keys, as when the keys were popped in turn
+    return dict(sorted(items, key=lambda item: item[0]))
+
+
+TEMPLATE_ACCESSOR = re.compile(
+    r"\s*(?:\.\s*([A-Za-z_][\w\-]*)|\[\s*'([^']*)'\s*\]|\[\s*\"([^\"]*)\"\s*\]|\[\s*(-?\d+)\s*\])"
+)
+TEMPLATE_FILTER = re.compile(r"^\s*([a-z_]+)\s*(?:\(\s*(-?\d*)\s*\))?\s*$")
+
+
+def templateRound(value, precision=""):
+    return round(float(value), int(precision) if precision else 0)
+
+
+TEMPLATE_FILTERS = {
+    "float": lambda value, arg="": float(value),
+    "int": lambda value, arg="": int(float(value)),
+    "round": templateRound,
+    "abs": lambda value, arg="": abs(value),
+    "string": lambda value, arg="": str(value),
+    "lower": lambda value, arg="": str(value).lower(),
+    "upper": lambda value, arg="": str(value).upper(),
+}
+
+
+class ValueTemplate:
+    # Home Assistant value template compiled to a Python accessor. Supported
+    # subset: {{ value }}, {{ value_json.a.b }}, {{ value_json['a']["b"][0] }},
+    # optionally followed by filters such as | float, | int and | round(1)
+    def __init__(self, template):
+        self.template = template
+        self.valid = False
+        self.path = None  # Keys into value_json, None for {{ value }}
+        self.key = None  # Last key of path
+        self.filters = []
+
+        m = re.match(r"^\s*{{(.*)}}\s*$", template, re.DOTALL)
+        if m is None:
+            return
+        parts = m.group(1).split("|")
+        expression = parts[0].strip()
+        for part in parts[1:]:
+            f = TEMPLATE_FILTER.match(part)
+            if f is None or f.group(1) not in TEMPLATE_FILTERS:
+                return
+            self.filters.append((TEMPLATE_FILTERS[f.group(1)], f.group(2) or ""))
+
+        if expression == "value":
+            self.valid = True
+            return
+        if not expression.startswith("value_json"):
+            return
+        path = []
+        pos = len("value_json")
+        while pos < len(expression):
+            a = TEMPLATE_ACCESSOR.match(expression, pos)
+            if a is None:
+                return
+            name, single, double, index = a.groups()
+            if index is not None:
+                path.append(int(index))
+            else:
+                path.append(name if name is not None else single or double)
+            pos = a.end()
+        if not path:
+            return
+        self.path = tuple(path)
+        self.key = self.path[-1]
+        self.valid = True
+
+    # Returns the container holding the templated value, None if not found
+    def parent(self, message):
+        return getPath(message, self.path[:-1])
+
+    # Returns the templated value, None if not found or not convertible
+    def render(self, message):
+        if not self.valid:
+            return None
+        value = message
+        if self.path is not None:
+            value = getPath(message, self.path)
+        if value is None:
+            return None
+        for f, arg in self.filters:
+            try:
+                value = f(value, arg)
+            except (ValueError, TypeError, ArithmeticError):
+                return None
+        return value
+
+
+def getPath(value, path):
+    for key in path:
+        if isinstance(value, dict):
+            value = value.get(key)
+        elif isinstance(value, list) and isinstance(key, int):
+            if key >= len(value) or key < -len(value):
+                return None
+            value = value[key]
+        else:
+            return None
+    return value
+
+
+compiledTemplates = {}
+
+
+# Returns the compiled template, shared between all devices using it
+def compileTemplate(template):
+    if not isinstance(template, str):
+        return None
+    compiled = compiledTemplates.get(template)
+    if compiled is None:
+        compiled = ValueTemplate(template)
+        compiledTemplates[template] = compiled
+    return compiled
+
+
+# Config keys of topics which carry device state and must be subscribed to
+STATE_TOPIC_KEYS = (
+    "availability_topic",
+    "state_topic",
+    "brightness_state_topic",
+    "rgb_state_topic",
+    "color_temp_state_topic",
+    "position_topic",
+)
+
+# Config keys of topics which are routed to the message handlers, a topic's
+# roles for a device are the keys it is the value of
+ROLE_TOPIC_KEYS = STATE_TOPIC_KEYS + ("tasmota_tele_topic",)
+
+# Roles handled by updateSwitch and updateSensor
+SWITCH_ROLES = frozenset(
+    (
+        "state_topic",
+        "tasmota_tele_topic",
+        "brightness_state_topic",
+        "rgb_state_topic",
+        "color_temp_state_topic",
+        "position_topic",
+    )
+)
+SENSOR_ROLES = frozenset(("state_topic", "tasmota_tele_topic"))
+
+
+class TopicTrie:
+    # Prefix trie over topic levels for the ignored topics. A rule matches a
+    # topic when its levels match the leading levels of the topic, '+' any
+    # level and '#' any remaining levels, and its last level is a prefix of
+    # the topic level at that position: "tasmota/sonoff/" matches all
+    # topics below tasmota/sonoff, as a plain string prefix would
+    def __init__(self, rules=()):
+        self.root = TopicTrieNode()
+        for rule in rules:
+            self.add(rule)
+
+    def add(self, rule):
+        levels = rule.split("/")
+        node = self.root
+        for level in levels[:-1]:
+            if level == "#":
+                break
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicTrieNode()
+            node = child
+        else:
+            last = levels[-1]
+            if last != "#":
+                if last == "+":
+                    last = ""
+                node.prefixes.setdefault(len(last), set()).add(last)
+                return
+        node.any = True
+
+    def matches(self, topic):
+        return self.matchLevels(self.root, topic.split("/"), 0)
+
+    # True if every topic the subscription filter matches is matched, the
+    # wildcards of the filter are only matched by wildcards of the rules
+    def covers(self, filter):
+        levels = filter.split("/")
+        if levels[-1] == "#":
+            levels[-1] = ""
+        return self.matchLevels(self.root, levels, 0)
+
+    def matchLevels(self, node, levels, index):
+        if node.any:
+            return True
+        if index == len(levels):
+            return False
+        level = levels[index]
+        for length, prefixes in node.prefixes.items():
+            if level[:length] in prefixes:
+                return True
+        child = node.children.get(level)
+        if child is not None and self.matchLevels(child, levels, index + 1):
+            return True
+        child = node.children.get("+")
+        if child is not None and self.matchLevels(child, levels, index + 1):
+            return True
+        return False
+
+
+class TopicTrieNode:
+    __slots__ = ("children", "prefixes", "any")
+
+    def __init__(self):
+        self.children = {}  # topic level -> TopicTrieNode
+        self.prefixes = {}  # prefix length -> set of last level prefixes
+        self.any = False  # '#' rule, matches whatever follows
+
+
+class TasmotaNode:
+    # Topics of a Tasmota node. Tasmota builds them from its FullTopic, e.g.
+    # %prefix%/%topic%/ or %topic%/%prefix%/, so they only differ in the level
+    # at prefixIndex (cmnd, stat or tele) and the command appended
+    def __init__(self, levels, prefixIndex):
+        self.levels = levels  # FullTopic levels with the tele prefix
+        self.prefixIndex = prefixIndex
+        self.teleTopic = self.topic("tele", "STATE")
+        self.cmndTopic = self.topic("cmnd")
+        self.statTopic = self.topic("stat")
+
+    def topic(self, prefix, command=""):
+        levels = list(self.levels)
+        levels[self.prefixIndex] = prefix
+        if command:
+            levels.append(command)
+        return "/".join(levels)
+
+    @classmethod
+    def parse(cls, topic, command):
+        # Node of a tele topic ending in command, None if it is not one
+        levels = topic.split("/")
+        if len(levels) < 2 or levels[-1] != command:
+            return None
+        levels.pop()
+        if "tele" not in levels:
+            return None
+        return cls(levels, levels.index("tele"))
+
+
+# Identifies the Options["config"] a snapshot descriptor was compiled from
+def configDigest(config):
+    if not isinstance(config, str):
+        return None
+    return hashlib.sha1(config.encode("utf8")).hexdigest()
+
+
+tasmotaNodes = {}  # tele STATE topic -> TasmotaNode
+tasmotaStatTopics = {}  # stat topic -> TasmotaNode
+
+
+# Returns the node of a tele STATE topic, shared between all its devices
+def getTasmotaNode(teleTopic):
+    node = tasmotaNodes.get(teleTopic)
+    if node is None:
+        node = TasmotaNode.parse(teleTopic, "STATE")
+        if node is None:
+            return None
+        tasmotaNodes[teleTopic] = node
+        tasmotaStatTopics[node.statTopic] = node
+    return node
+
+
+class DeviceDescriptor:
+    # Compiled view of a device's Options["config"], built once per config so
+    # message and command handlers never decode JSON or probe for keys
+
+    # Attributes holding compiled templates
+    TEMPLATES = (
+        "value_template",
+        "brightness_value_template",
+        "rgb_value_template",
+        "color_temp_value_template",
+        "availability_template",
+    )
+
+    # Plain data attributes saved in the warm start snapshot, the templates
+    # are saved as their source and the Tasmota node as its tele topic. The
+    # config is left out, it is rarely needed and decoded again on demand.
+    # Sets are saved as lists, JSON has no sets.
+    SNAPSHOT_FIELDS = (
+        "unit",
+        "devicename",
+        "component",
+        "state_topic",
+        "command_topic",
+        "availability_topic",
+        "brightness_state_topic",
+        "brightness_command_topic",
+        "rgb_state_topic",
+        "rgb_command_topic",
+        "color_temp_state_topic",
+        "color_temp_command_topic",
+        "position_topic",
+        "set_position_topic",
+        "tasmota_tele_topic",
+        "payload_on",
+        "payload_off",
+        "payload_stop",
+        "payload_open",
+        "payload_close",
+        "state_open",
+        "state_close",
+        "state_stop",
+        "payload_available",
+        "payload_not_available",
+        "brightness_scale",
+        "expire_after",
+        "topics",
+        "roles",
+        "subscriptions",
+        "tasmota_relay",
+    )
+
+    def __init__(self, unit, devicename, config, component=""):
+        if not isinstance(config, dict):
+            raise TypeError("config is not a JSON object")
+        self.unit = unit
+        self.devicename = devicename
+        self.config = config
+        # Discovery component, "" for devices discovered before it was stored
+        self.component = component
+
+        # Topics
+        self.state_topic = self.getTopic("state_topic")
+        self.command_topic = self.getTopic("command_topic")
+        self.availability_topic = self.getTopic("availability_topic")
+        self.brightness_state_topic = self.getTopic("brightness_state_topic")
+        self.brightness_command_topic = self.getTopic("brightness_command_topic")
+        self.rgb_state_topic = self.getTopic("rgb_state_topic")
+        self.rgb_command_topic = self.getTopic("rgb_command_topic")
+        self.color_temp_state_topic = self.getTopic("color_temp_state_topic")
+        self.color_temp_command_topic = self.getTopic("color_temp_command_topic")
+        self.position_topic = self.getTopic("position_topic")
+        self.set_position_topic = self.getTopic("set_position_topic")
+        self.tasmota_tele_topic = self.getTopic("tasmota_tele_topic")
+
+        # Payloads, None if not present in config
+        self.payload_on = config.get("payload_on")
+        self.payload_off = config.get("payload_off")
+        self.payload_stop = config.get("payload_stop")
+        self.payload_open = config.get("payload_open")
+        self.payload_close = config.get("payload_close")
+        self.state_open = config.get("state_open")
+        self.state_close = config.get("state_close")
+        self.state_stop = config.get("state_stop")
+        self.payload_available = config.get("payload_available")
+        self.payload_not_available = config.get("payload_not_available")
+
+        # Templates
+        self.value_template = compileTemplate(config.get("value_template"))
+        self.brightness_value_template = compileTemplate(
+            config.get("brightness_value_template")
+        )
+        self.rgb_value_template = compileTemplate(config.get("rgb_value_template"))
+        self.color_temp_value_template = compileTemplate(
+            config.get("color_temp_value_template")
+        )
+        self.availability_template = compileTemplate(
+            config.get("availability_template")
+        )
+
+        # Scales
+        self.brightness_scale = config.get("brightness_scale", 255)
+
+        # Seconds without state update after which the device is timed out
+        self.expire_after = None
+        expire_after = config.get("expire_after")
+        if isinstance(expire_after, (int, float)) and expire_after > 0:
+            self.expire_after = expire_after
+
+        # All topics referenced by the config, used for message routing
+        self.topics = set()
+        for key, value in config.items():
+            if key.endswith("_topic") and isinstance(value, str) and value:
+                self.topics.add(value)
+
+        # Roles of every routed topic, topic -> frozenset of config keys
+        roles = {}
+        for key in ROLE_TOPIC_KEYS:
+            topic = self.getTopic(key)
+            if topic:
+                roles.setdefault(topic, set()).add(key)
+        self.roles = {topic: frozenset(keys) for topic, keys in roles.items()}
+        # Message handlers per topic, set by BasePlugin.routeDevice
+        self.handlers = {}
+
+        # Topics to subscribe to
+        self.subscriptions = set()
+        for key in STATE_TOPIC_KEYS:
+            topic = self.getTopic(key)
+            if topic:
+                self.subscriptions.add(topic)
+
+        # Tasmota node and relay number, "" for a single relay
+        self.tasmota = None
+        self.tasmota_relay = ""
+        if self.tasmota_tele_topic:
+            self.tasmota = getTasmotaNode(self.tasmota_tele_topic)
+        if self.tasmota is not None:
+            # Subscribe to all Tasmota state topics
+            self.subscriptions.add(self.tasmota.statTopic + "/#")
+            if devicename[-2:-1] == "_" and devicename[-1:].isdigit():
+                self.tasmota_relay = devicename[-1]
+
+    def getTopic(self, key):
+        value = self.config.get(key)
+        if isinstance(value, str) and value:
+            return value
+        return None
+
+    @classmethod
+    def fromDevice(cls, unit, device):
+        # Raises ValueError, KeyError or TypeError if the device has no valid config
+        config = json.loads(device.Options["config"])
+        if isinstance(config, dict):
+            config = expandConfig(config)
+        return cls(
+            unit,
+            device.Options.get("devicename", ""),
+            config,
+            device.Options.get("component", ""),
+        )
+
+    # The expanded config, decoded from the device Options on first use for
+    # descriptors restored from the snapshot
+    def getConfig(self, device):
+        if self.config is None:
+            self.config = expandConfig(json.loads(device.Options["config"]))
+        return self.config
+
+    # Plain data state for the warm start snapshot, without the handlers and
+    # the shared templates and Tasmota node
+    def getSnapshot(self):
+        state = {name: getattr(self, name) for name in self.SNAPSHOT_FIELDS}
+        state["topics"] = sorted(self.topics)
+        state["subscriptions"] = sorted(self.subscriptions)
+        state["roles"] = {topic: sorted(keys) for topic, keys in self.roles.items()}
+        for name in self.TEMPLATES:
+            template = getattr(self, name)
+            state[name] = None if template is None else template.template
+        return state
+
+    # Returns None if the state lacks any of the snapshot fields
+    @classmethod
+    def fromSnapshot(cls, state):
+        if not isinstance(state, dict):
+            return None
+        descriptor = cls.__new__(cls)
+        for name in cls.SNAPSHOT_FIELDS:
+            if name not in state:
+                return None
+            setattr(descriptor, name, state[name])
+        for name in cls.TEMPLATES:
+            if name not in state:
+                return None
+            setattr(descriptor, name, compileTemplate(state[name]))
+        if (
+            not isinstance(descriptor.topics, list)
+            or not isinstance(descriptor.subscriptions, list)
+            or not isinstance(descriptor.roles, dict)
+        ):
+            return None
+        descriptor.topics = set(descriptor.topics)
+        descriptor.subscriptions = set(descriptor.subscriptions)
+        descriptor.roles = {
+            topic: frozenset(keys) for topic, keys in descriptor.roles.items()
+        }
+        descriptor.config = None
+        descriptor.tasmota = None
+        if descriptor.tasmota_tele_topic:
+            descriptor.tasmota = getTasmotaNode(descriptor.tasmota_tele_topic)
+        descriptor.handlers = {}
+        return descriptor
+
+
 class BasePlugin:
     # MQTT settings
     mqttClient = None
     mqttserveraddress = ""
     mqttserverport = ""
     debugging = "Normal"
-    cachedDeviceNames = {}
 
     options = {
         "addDiscoveredDeviceUsed": True,  # Newly discovered devices added as "used" (visible in swithces tab) or not (only visible in devices list)
         "updateRSSI": False,  # Store Tasmota RSSI
-        "updateVCC": False,
-    }  # Store Tasmota VCC as battery level
+        "updateVCC": False,  # Store Tasmota VCC as battery level
+        "discoveryQuietPeriod": 5,  # Seconds without discovery config after (re)connect before buffered configs are processed, 0 to process immediately
+        "logRateLimit": 0,  # Max state change / publish log lines per device or topic per minute, 0 for no limit
+        "logSummaryInterval": 0,  # Replace state change / publish log lines by a summary every N seconds, 0 to log every line
+        "minUpdateInterval": 0,  # Min seconds between state writes of a device, changes within the interval are merged and written when it is over, 0 to write every change
+        "minUpdateIntervals": {},  # Min update interval per devicename or component (e.g. {"sensor": 30}), overrides minUpdateInterval
+        "refreshRate": 5,  # Tasmota nodes per second asked for their configuration after (re)subscribing, 0 for all at once
+        "refreshMinAge": 3600,  # Seconds after a Tasmota node answered a refresh before it is refreshed again on resubscribe
+        "publishQueueSize": 100,  # Max messages queued while disconnected, oldest are dropped
+        "publishQueueMaxAge": 60,  # Seconds after which messages queued while disconnected are dropped
+        "reconnectMaxDelay": 300,  # Max seconds between reconnect attempts, the delay doubles from 10 s after every failure
+        "keepAlive": 60,  # Send PING after this many seconds without MQTT traffic in either direction
+        "pingTimeout": 30,  # Reconnect if nothing is received this many seconds after a PING
+        "statsInterval": 0,  # Publish plugin statistics every N seconds, 0 to disable
+        "statsTopic": "",  # Topic for the statistics, default <discovery topic>/domoticz_stats/<hardware id>
+        "statsDevices": False,  # Also show the main statistics as Custom sensor devices
+        "recordFile": "",  # Record received MQTT messages to this file (relative to the plugin folder) for replaying, empty to disable
+        "snapshotInterval": 600,  # Min seconds between saves of the device index snapshot used to speed up start, 0 to disable
+    }
 
     def copyDevices(self):
         # self.cachedDevices = copy.deepcopy(Devices)
+        self.cachedDeviceNames = {}
         for k, Device in Devices.items():
             self.cachedDeviceNames[k] = Device.Name
 
+    def cacheDeviceName(self, unit):
+        if unit in Devices:
+            self.cachedDeviceNames[unit] = Devices[unit].Name
+        else:
+            self.cachedDeviceNames.pop(unit, None)
+
     def deviceStr(self, unit):
         name = "<UNKNOWN>"
         if unit in Devices:
             name = Devices[unit].Name
         return format(unit, "03d") + "/" + name
 
-    def getUnit(self, device):
-        unit = -1
-        for k, dev in Devices.items():
-            if dev == device:
-                unit = k
-        return unit
-
     def onStart(self):
 
         # Parse options
@@ -381,7 +1398,9 @@ class BasePlugin:
         self.mqttserveraddress = Parameters["Address"].replace(" ", "")
         self.mqttserverport = Parameters["Port"].replace(" ", "")
         self.discoverytopic = Parameters["Mode2"]
-        self.ignoredtopics = Parameters["Mode4"].split(",")
+        self.ignoredtopics = TopicTrie(
+            rule.strip() for rule in Parameters["Mode4"].split(",") if rule.strip()
+        )
 
         options = ""
         try:
@@ -408,11 +1427,16 @@ class BasePlugin:
             except ValueError:  # Options not a valid int
                 pass
         elif type(options) == dict:
-            self.options.add(options)
+            self.options.update(options)
         Domoticz.Log("Plugin options: " + str(self.options))
+        logger.configure(
+            self.debugging,
+            self.options["logRateLimit"],
+            self.options["logSummaryInterval"],
+        )
 
         # Enable heartbeat
-        Domoticz.Heartbeat(10)
+        Domoticz.Heartbeat(HEARTBEAT_INTERVAL)
 
         # Connect to MQTT server
         self.prefixpos = 0
@@ -425,10 +1449,117 @@ class BasePlugin:
             self.onMQTTDisconnected,
             self.onMQTTPublish,
             self.onMQTTSubscribed,
+            self.options["publishQueueSize"],
+            self.options["publishQueueMaxAge"],
+            self.options["reconnectMaxDelay"],
+            self.options["keepAlive"],
+            self.options["pingTimeout"],
         )
+        if self.options["recordFile"] != "":
+            path = os.path.join(Parameters["HomeFolder"], self.options["recordFile"])
+            try:
+                self.mqttClient.recorder = MqttRecorder(path)
+                Domoticz.Log("Recording MQTT messages to " + path)
+            except OSError as e:
+                Domoticz.Error("Could not open record file " + path + ": " + str(e))
 
         self.copyDevices()
 
+        # Build topic to unit routing index
+        self.topicIndex = {}
+        self.descriptors = {}
+        self.devicenameUnits = {}
+        self.unitDevicenames = {}
+        self.fingerprints = {}  # devicename -> fingerprint of its config payload
+        self.freeUnit = 1  # No unused unit below this one
+        self.subscriptionIndex = {}
+        self.addedSubscriptions = set()
+        self.removedSubscriptions = set()
+        # Descriptors of devices whose config did not change since the
+        # snapshot was saved are restored, the others are compiled again
+        self.snapshotPath = os.path.join(
+            Parameters["HomeFolder"],
+            "MQTTDiscovery_" + str(Parameters["HardwareID"]) + ".snapshot",
+        )
+        self.lastSnapshot = time.time()
+        snapshot = {}
+        if self.options["snapshotInterval"] > 0:
+            snapshot = self.loadSnapshot()
+        restored = 0
+        for unit in Devices:
+            descriptor = None
+            entry = snapshot.pop(str(unit), None)
+            options = Devices[unit].Options
+            if (
+                isinstance(entry, list)
+                and len(entry) == 2
+                and entry[0] == configDigest(options.get("config"))
+            ):
+                descriptor = DeviceDescriptor.fromSnapshot(entry[1])
+            if descriptor is not None and (
+                descriptor.unit != unit
+                or descriptor.devicename != options.get("devicename", "")
+                or descriptor.component != options.get("component", "")
+            ):
+                descriptor = None
+            if descriptor is not None:
+                restored += 1
+            self.indexDevice(unit, descriptor=descriptor)
+        self.snapshotDirty = restored < len(self.descriptors) or len(snapshot) > 0
+        if restored:
+            Domoticz.Log(
+                "Restored %d of %d device descriptors from snapshot"
+                % (restored, len(self.descriptors))
+            )
+        # Initial subscriptions are sent by onMQTTConnected
+        self.addedSubscriptions.clear()
+
+        # Discovery configs buffered during the retained message burst
+        self.discoveryBurst = None  # Start time of current burst
+        self.lastDiscovery = 0
+        self.pendingDiscovery = {}
+        self.bulkDiscovery = False
+
+        # Device changes of the message being handled, unit -> [fields, suppressTriggers]
+        self.pendingUpdates = {}
+        # Statistics
+        metrics.enabled = self.options["statsInterval"] > 0
+        metrics.reset(time.time())
+        self.statsTopic = self.options["statsTopic"] or (
+            self.discoverytopic + "/domoticz_stats/" + str(Parameters["HardwareID"])
+        )
+        self.statsUnits = {}  # Options["statsname"] -> unit, None once deleted
+        for unit, device in Devices.items():
+            if "statsname" in device.Options:
+                self.statsUnits[device.Options["statsname"]] = unit
+
+        # Tasmota configuration refreshes, heap of (priority, sequence, cmnd topic)
+        self.refreshQueue = []
+        self.queuedRefreshes = set()
+        self.refreshSequence = 0
+        self.refreshCredit = max(1, self.options["refreshRate"])
+        self.refreshTime = time.time()
+        self.lastRefresh = {}  # cmnd topic -> time of last STATUS reply
+
+        # Changes held back by the minimum update interval and last write times
+        self.heldUpdates = {}
+        self.lastWrites = {}
+
+        # Schedule sensor time outs
+        self.deadlines = {}
+        self.queuedDeadlines = {}
+        self.deadlineQueue = []
+        for unit, device in Devices.items():
+            self.scheduleTimeout(unit, self.getLastUpdate(device))
+
+    def onStop(self):
+        if self.options["snapshotInterval"] > 0 and self.snapshotDirty:
+            self.saveSnapshot()
+        if self.mqttClient is not None and self.mqttClient.recorder is not None:
+            Domoticz.Log("Recorded %d MQTT messages" % self.mqttClient.recorder.count)
+            self.mqttClient.recorder.close()
+            self.mqttClient.recorder = None
+
     def onConnect(self, Connection, Status, Description):
         self.mqttClient.onConnect(Connection, Status, Description)
 
@@ -441,135 +1572,163 @@ class BasePlugin:
     def onMQTTConnected(self):
         Domoticz.Debug("onMQTTConnected")
         self.mqttClient.Subscribe(self.getTopics())
+        # The broker now replays all retained discovery configs, the quiet
+        # period counts from now. A burst still running keeps its start time
+        # for the DISCOVERY_BURST_MAX_DURATION cap.
+        if self.options["discoveryQuietPeriod"] > 0:
+            self.lastDiscovery = time.time()
+            if self.discoveryBurst is None:
+                self.discoveryBurst = self.lastDiscovery
 
     def onMQTTDisconnected(self):
         Domoticz.Debug("onMQTTDisconnected")
 
-    def onMQTTPublish(self, topic, rawmessage):
-        validJSON = False
-        message = ""
-        try:
-            message = json.loads(rawmessage.decode("utf8"))
-            validJSON = True
-        except ValueError:
-            message = rawmessage.decode("utf8")
+    # Returns (component, devicename, action) for a discovery topic, None if
+    # the topic does not have the discovery topic format
+    def parseDiscoveryTopic(self, topiclist):
+        discoverytopiclen = len(self.discoverytopiclist)
+        # Discovery topic format:
+        # <discovery_prefix>/<component>/[<node_id>/]<object_id>/<action>
+        if len(topiclist) == discoverytopiclen + 3:
+            component = topiclist[discoverytopiclen]
+            node_id = ""
+            object_id = topiclist[discoverytopiclen + 1]
+            action = topiclist[discoverytopiclen + 2]
+        elif len(topiclist) == discoverytopiclen + 4:
+            component = topiclist[discoverytopiclen]
+            node_id = topiclist[discoverytopiclen + 1]
+            object_id = topiclist[discoverytopiclen + 2]
+            action = topiclist[discoverytopiclen + 3]
+        else:
+            return None
+
+        # Sensor support
+        if (component == "sensor") and (node_id != ""):
+            object_id = node_id
+        return component, object_id, action
 
-        topiclist = topic.split("/")
-        if self.debugging == "Verbose" or self.debugging == "Verbose+":
+    def onMQTTPublish(self, topic, rawmessage):
+        if logger.verbose:
             DumpMQTTMessageToLog(topic, rawmessage, "onMQTTPublish: ")
 
-        if topic in self.ignoredtopics:
-            Domoticz.Debug(
-                "Topic: '" + topic + "' included in ignored topics, message ignored"
+        if self.ignoredtopics.matches(topic):
+            logger.debug(
+                "Topic: '%s' included in ignored topics, message ignored", topic
             )
             return
 
+        # Skip retained discovery configs which are byte for byte the ones the
+        # existing device was configured from, before parsing them
+        discovery = None
+        fingerprint = None
         if topic.startswith(self.discoverytopic):
-            discoverytopiclen = len(self.discoverytopiclist)
-            # Discovery topic format:
-            # <discovery_prefix>/<component>/[<node_id>/]<object_id>/<action>
-            if (
-                len(topiclist) == discoverytopiclen + 3
-                or len(topiclist) == discoverytopiclen + 4
-            ):
-                component = topiclist[discoverytopiclen]
-                if len(topiclist) == discoverytopiclen + 3:
-                    node_id = ""
-                    object_id = topiclist[discoverytopiclen + 1]
-                    action = topiclist[discoverytopiclen + 2]
-                else:
-                    node_id = topiclist[discoverytopiclen + 1]
-                    object_id = topiclist[discoverytopiclen + 2]
-                    action = topiclist[discoverytopiclen + 3]
-
-                # Sensor support
-                if (component == "sensor") and (node_id != ""):
-                    object_id = node_id
-
+            discovery = self.parseDiscoveryTopic(topic.split("/"))
+            if discovery is not None and discovery[2] == "config":
+                devicename = discovery[1]
+                fingerprint = hashlib.sha1(rawmessage).hexdigest()
                 if (
-                    validJSON
-                    and action == "config"
-                    and (
-                        "command_topic" in message
-                        or "state_topic" in message
-                        or "cmd_t" in message
-                        or "stat_t" in message
-                    )
+                    self.fingerprints.get(devicename) == fingerprint
+                    and self.devicenameUnits.get(devicename) in Devices
+                    and "component" in Devices[self.devicenameUnits[devicename]].Options
                 ):
-                    # Do expansion of the message
-                    payload = dict(message)
-                    for key in list(payload.keys()):
-                        abbreviated_key = key
-                        key = ABBREVIATIONS.get(key, key)
-                        payload[key] = payload.pop(abbreviated_key)
-
-                    if CONF_DEVICE in payload:
-                        device = payload[CONF_DEVICE]
-                        for key in list(device.keys()):
-                            abbreviated_key = key
-                            key = DEVICE_ABBREVIATIONS.get(key, key)
-                            device[key] = device.pop(abbreviated_key)
-
-                    base = payload.pop(TOPIC_BASE, None)
-                    if base:
-                        for key, value in payload.items():
-                            if isinstance(value, str) and value:
-                                if value[0] == TOPIC_BASE and key.endswith("_topic"):
-                                    payload[key] = "{}{}".format(base, value[1:])
-                                if value[-1] == TOPIC_BASE and key.endswith("_topic"):
-                                    payload[key] = "{}{}".format(value[:-1], base)
-
-                    # Add / update the device
-                    self.updateDeviceSettings(object_id, component, payload)
-        else:
-            matchingDevices = self.getDevices(topic=topic)
-            for device in matchingDevices:
-                self.updateSwitch(device, topic, message)
+                    logger.debug("Unchanged config for '%s' skipped", devicename)
+                    metrics.count("unchangedConfigs")
+                    # Supersedes a different config buffered earlier
+                    self.pendingDiscovery.pop(devicename, None)
+                    return
 
-                # Try to update availability
-                self.updateAvailability(device, topic, message)
+        # Decoded when a handler asks for it, most messages have none
+        message = MqttPayload(rawmessage)
 
-                # Try to update sensor
-                self.updateSensor(device, topic, message)
-
-                # TODO: Try to update binary sensor
-                # self.updateBinarySensor(device, topic, message)
+        if topic.startswith(self.discoverytopic):
+            if discovery is not None:
+                component, object_id, action = discovery
+                if action == "config" and isinstance(message.value, dict):
+                    payload = expandConfig(message.value)
+                    if "command_topic" in payload or "state_topic" in payload:
+                        # Add / update the device
+                        self.discoverDevice(object_id, component, payload, fingerprint)
+        else:
+            for descriptor in self.getDescriptors(topic):
+                handlers = descriptor.handlers.get(topic)
+                if handlers:
+                    device = Devices[descriptor.unit]
+                    roles = descriptor.roles[topic]
+                    for handler in handlers:
+                        if metrics.enabled:
+                            start = time.perf_counter()
+                            handler(device, descriptor, topic, roles, message.value)
+                            metrics.timing(
+                                handler.__name__, time.perf_counter() - start
+                            )
+                        else:
+                            handler(device, descriptor, topic, roles, message.value)
+
+            # Special handling of Tasmota STATUS messages
+            stattopic, _, command = topic.rpartition("/")
+            if command.startswith("STATUS") and command[6:].isdigit():
+                node = tasmotaStatTopics.get(stattopic)
+                if node is not None:
+                    # The node answered, not asked again within refreshMinAge
+                    self.lastRefresh[node.cmndTopic] = time.time()
+                    for descriptor in self.getDescriptors(node.teleTopic):
+                        # Try to update tasmota settings
+                        self.updateTasmotaSettings(
+                            Devices[descriptor.unit], descriptor, topic, message.value
+                        )
 
-                # TODO: Try to update tasmota status
-                self.updateTasmotaStatus(device, topic, message)
+            # Write the device changes made by the handlers
+            self.flushUpdates()
 
-            # Special handling of Tasmota STATE message
-            topic2, matches = re.subn(r"\/STATUS\d+$", "/STATE", topic)
-            if matches > 0:
-                topic2, matches = re.subn(r"\/stat\/", "/tele/", topic2)
-                if matches > 0:
-                    matchingDevices = self.getDevices(topic=topic2)
-                    for device in matchingDevices:
-                        # Try to update tasmota settings
-                        self.updateTasmotaSettings(device, topic, message)
+            # Replies to refreshes arrive here, keep the refresh queue moving
+            if self.refreshQueue:
+                self.processRefreshQueue(time.time())
 
     def onMQTTSubscribed(self):
         # (Re)subscribed, refresh device info
-        Domoticz.Debug("onMQTTSubscribed")
-        matchingDevices = self.getDevices(hasconfigkey="tasmota_tele_topic")
-        topics = set()
-        for device in matchingDevices:
-            # Refresh Tasmota specific data
-            try:
-                configdict = json.loads(device.Options["config"])
-                cmnd_topic = re.sub(
-                    r"^tele\/", "cmnd/", configdict["tasmota_tele_topic"]
-                )  # Replace tele with cmnd
-                cmnd_topic = re.sub(
-                    r"\/tele\/", "/cmnd/", cmnd_topic
-                )  # Replace tele with cmnd
-                cmnd_topic = re.sub(r"\/STATE", "", cmnd_topic)  # Remove '/STATE'
-                if cmnd_topic not in topics:
-                    self.refreshConfiguration(cmnd_topic)
-                topics.add(cmnd_topic)
-            except (ValueError, KeyError, TypeError) as e:
-                # Domoticz.Error("onMQTTSubscribed: Error: " + str(e))
-                Domoticz.Error(traceback.format_exc())
+        logger.debug("onMQTTSubscribed")
+        now = time.time()
+        nodes = {}  # Tasmota cmnd topic -> description known
+        for descriptor in self.descriptors.values():
+            if descriptor.tasmota is not None and descriptor.unit in Devices:
+                cmnd_topic = descriptor.tasmota.cmndTopic
+                known = Devices[descriptor.unit].Description.startswith("IP: ")
+                nodes[cmnd_topic] = nodes.get(cmnd_topic, True) and known
+        for cmnd_topic, known in nodes.items():
+            # Refresh Tasmota specific data, nodes without IP first. Nodes
+            # which answered recently are skipped
+            if (
+                now - self.lastRefresh.get(cmnd_topic, 0)
+                < self.options["refreshMinAge"]
+            ):
+                continue
+            self.queueRefresh(cmnd_topic, 1 if known else 0)
+        self.processRefreshQueue(now)
+
+    def queueRefresh(self, cmnd_topic, priority):
+        if cmnd_topic not in self.queuedRefreshes:
+            self.queuedRefreshes.add(cmnd_topic)
+            self.refreshSequence += 1
+            heapq.heappush(
+                self.refreshQueue, (priority, self.refreshSequence, cmnd_topic)
+            )
+
+    # Send queued configuration refreshes, at most refreshRate nodes per second
+    # so the replies of many nodes do not arrive all at once. Called on every
+    # heartbeat and received message, the credit never exceeds one second's
+    # worth so a quiet spell does not turn into a burst.
+    def processRefreshQueue(self, now):
+        rate = self.options["refreshRate"]
+        if rate > 0:
+            self.refreshCredit = min(
+                self.refreshCredit + (now - self.refreshTime) * rate, max(1, rate)
+            )
+        self.refreshTime = now
+        while self.refreshQueue and (rate <= 0 or self.refreshCredit >= 1):
+            priority, sequence, cmnd_topic = heapq.heappop(self.refreshQueue)
+            self.queuedRefreshes.discard(cmnd_topic)
+            self.refreshCredit -= 1
+            self.refreshConfiguration(cmnd_topic)
 
     # ==========================================================DASHBOARD COMMAND=============================================================
     def onCommand(self, Unit, Command, Level, sColor):
@@ -584,160 +1743,123 @@ class BasePlugin:
             + str(sColor)
         )
 
-        if Unit in Devices:
-            try:
-                # TODO: Make sure the relevant command topic exists
-                configdict = json.loads(Devices[Unit].Options["config"])
-                if Command == "Set Level" and "set_position_topic" in configdict:
-                    self.mqttClient.Publish(
-                        configdict["set_position_topic"], str(Level)
-                    )
-                elif Command == "Set Brightness" or Command == "Set Level":
-                    self.mqttClient.Publish(
-                        configdict["brightness_command_topic"], str(Level)
-                    )
-                elif Command == "On":
-                    payload = "ON"
-                    if "payload_on" in configdict:
-                        payload = configdict["payload_on"]
-                    elif "payload_close" in configdict:
-                        payload = configdict["payload_close"]
-                    self.mqttClient.Publish(configdict["command_topic"], payload)
-                elif Command == "Off":
-                    payload = "OFF"
-                    if "payload_off" in configdict:
-                        payload = configdict["payload_off"]
-                    elif "payload_open" in configdict:
-                        payload = configdict["payload_open"]
-                    self.mqttClient.Publish(configdict["command_topic"], payload)
-                elif Command == "Stop":
-                    payload = "STOP"
-                    if "payload_stop" in configdict:
-                        payload = configdict["payload_stop"]
-                    self.mqttClient.Publish(configdict["command_topic"], payload)
-                elif Command == "Set Color":
-                    try:
-                        Color = json.loads(sColor)
-                    except (ValueError, KeyError, TypeError) as e:
-                        Domoticz.Error(
-                            "onCommand: Illegal color: '" + str(sColor) + "'"
-                        )
+        descriptor = self.descriptors.get(Unit)
+        if Unit in Devices and descriptor is not None:
+            if Command == "Set Level" and descriptor.set_position_topic:
+                self.publishCommand(Unit, descriptor.set_position_topic, str(Level))
+            elif Command == "Set Brightness" or Command == "Set Level":
+                self.publishCommand(
+                    Unit, descriptor.brightness_command_topic, str(Level)
+                )
+            elif Command == "On":
+                payload = "ON"
+                if descriptor.payload_on is not None:
+                    payload = descriptor.payload_on
+                elif descriptor.payload_close is not None:
+                    payload = descriptor.payload_close
+                self.publishCommand(Unit, descriptor.command_topic, payload)
+            elif Command == "Off":
+                payload = "OFF"
+                if descriptor.payload_off is not None:
+                    payload = descriptor.payload_off
+                elif descriptor.payload_open is not None:
+                    payload = descriptor.payload_open
+                self.publishCommand(Unit, descriptor.command_topic, payload)
+            elif Command == "Stop":
+                payload = "STOP"
+                if descriptor.payload_stop is not None:
+                    payload = descriptor.payload_stop
+                self.publishCommand(Unit, descriptor.command_topic, payload)
+            elif Command == "Set Color":
+                try:
+                    Color = json.loads(sColor)
                     # TODO: This is not really correct, should check color mode
                     r = int(Color["r"] * Level / 100)
                     g = int(Color["g"] * Level / 100)
                     b = int(Color["b"] * Level / 100)
                     cw = int(Color["cw"] * Level / 100)
                     ww = int(Color["ww"] * Level / 100)
-                    if (
-                        "rgb_command_topic" in configdict
-                        and "brightness_command_topic" in configdict
-                    ):
-                        self.mqttClient.Publish(
-                            configdict["rgb_command_topic"],
-                            format(r, "02x")
-                            + format(g, "02x")
-                            + format(b, "02x")
-                            + format(cw, "02x")
-                            + format(ww, "02x"),
-                        )
-                        self.mqttClient.Publish(
-                            configdict["brightness_command_topic"], str(Level)
-                        )
-                    elif (
-                        "color_temp_command_topic" in configdict
-                        and "brightness_command_topic" in configdict
-                    ):
-                        self.mqttClient.Publish(
-                            configdict["color_temp_command_topic"],
-                            str(Color["t"] * (500 - 153) / 255 + 153),
-                        )
-                        self.mqttClient.Publish(
-                            configdict["brightness_command_topic"], str(Level)
-                        )
-            except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Error("onCommand: Error: " + str(e))
+                    t = Color["t"]
+                except (ValueError, KeyError, TypeError) as e:
+                    Domoticz.Error("onCommand: Illegal color: '" + str(sColor) + "'")
+                    return
+                if descriptor.rgb_command_topic and descriptor.brightness_command_topic:
+                    self.mqttClient.Publish(
+                        descriptor.rgb_command_topic,
+                        format(r, "02x")
+                        + format(g, "02x")
+                        + format(b, "02x")
+                        + format(cw, "02x")
+                        + format(ww, "02x"),
+                    )
+                    self.mqttClient.Publish(
+                        descriptor.brightness_command_topic, str(Level)
+                    )
+                elif (
+                    descriptor.color_temp_command_topic
+                    and descriptor.brightness_command_topic
+                ):
+                    self.mqttClient.Publish(
+                        descriptor.color_temp_command_topic,
+                        str(t * (500 - 153) / 255 + 153),
+                    )
+                    self.mqttClient.Publish(
+                        descriptor.brightness_command_topic, str(Level)
+                    )
         else:
             Domoticz.Debug("Device not found, ignoring command")
 
+    def publishCommand(self, Unit, topic, payload):
+        if topic:
+            self.mqttClient.Publish(topic, payload)
+        else:
+            Domoticz.Error(
+                "onCommand: " + self.deviceStr(Unit) + ": No command topic configured"
+            )
+
     def onDeviceAdded(self, Unit):
         Domoticz.Log("onDeviceAdded " + self.deviceStr(Unit))
-        self.copyDevices()
-        # TODO: Update subscribed topics
+        if Unit not in self.descriptors:
+            self.indexDevice(Unit)
+            self.updateSubscriptions()
+        self.cacheDeviceName(Unit)
 
     def onDeviceModified(self, Unit):
         Domoticz.Log("onDeviceModified " + self.deviceStr(Unit))
 
-        if Unit in Devices and Devices[Unit].Name != self.cachedDeviceNames[Unit]:
+        if Unit in Devices and Devices[Unit].Name != self.cachedDeviceNames.get(Unit):
             Domoticz.Log(
                 "Device name changed, new name: "
                 + Devices[Unit].Name
                 + ", old name: "
-                + self.cachedDeviceNames[Unit]
+                + str(self.cachedDeviceNames.get(Unit))
             )
             Device = Devices[Unit]
+            descriptor = self.descriptors.get(Unit)
 
-            try:
-                configdict = json.loads(Device.Options["config"])
-                if (
-                    "tasmota_tele_topic" in configdict and Device.SwitchType != 9
-                ):  # Do not set friendly name for button, they don't have their own friendly name
-                    # Tasmota device!
-                    device_nbr = ""
-                    m = re.match(r".*_(\d)$", str(Device.Options["devicename"]))
-                    if m:
-                        device_nbr = m.group(1)
-                    cmnd_topic = re.sub(
-                        r"\/POWER\d?", "", configdict["command_topic"]
-                    )  # Remove '/POWER'
-                    self.mqttClient.Publish(
-                        cmnd_topic + "/FriendlyName" + str(device_nbr), Device.Name
-                    )
-            except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Debug("onDeviceModified: Error: " + str(e))
-                pass
+            if (
+                descriptor is not None
+                and descriptor.tasmota is not None
+                and descriptor.command_topic
+                and Device.SwitchType != 9
+            ):  # Do not set friendly name for button, they don't have their own friendly name
+                # Tasmota device!
+                self.mqttClient.Publish(
+                    descriptor.tasmota.topic(
+                        "cmnd", "FriendlyName" + descriptor.tasmota_relay
+                    ),
+                    Device.Name,
+                )
 
-        self.copyDevices()
+        self.cacheDeviceName(Unit)
 
     def onDeviceRemoved(self, Unit):
         Domoticz.Log("onDeviceRemoved " + self.deviceStr(Unit))
         if Unit in Devices and "devicename" in Devices[Unit].Options:
-            Device = Devices[Unit]
             # Clear retained topic
-            devicetype = ""
-            if (
-                Device.Type == 0xF4
-                and Device.SubType == 0x49  # pTypeGeneralSwitch
-                and Device.SwitchType == 0  # sSwitchGeneralSwitch
-            ):  # OnOff
-                devicetype = "switch"
-            elif (
-                Device.Type == 0xF4
-                and Device.SubType == 0x49  # pTypeGeneralSwitch
-                and Device.SwitchType == 7  # sSwitchGeneralSwitch
-            ):  # Dimmer
-                devicetype = "light"
-            elif Device.Type == 0xF1:  # pTypeColorSwitch
-                devicetype = "light"
-            elif (
-                Device.Type == 0xF4
-                and Device.SubType == 0x49  # pTypeGeneralSwitch
-                and (  # sSwitchGeneralSwitch
-                    (Device.SwitchType == 3)
-                    or (Device.SwitchType == 15)  # Blind (up/down buttons)
-                    or (  # Venetian blinds EU (up/down/stop buttons)
-                        Device.SwitchType == 13
-                    )
-                )
-            ):  # Blinds Percentage
-                devicetype = "blinds"
-            elif (
-                Device.Type == 0xF4
-                and Device.SubType == 0x49  # pTypeGeneralSwitch
-                and Device.SwitchType == 9  # sSwitchGeneralSwitch
-            ):  # STYPE_PushOn
-                devicetype = "binary_sensor"
-            elif self.isMQTTSensor(Device):
-                devicetype = "sensor"
+            devicetype = Devices[Unit].Options.get("component") or self.getDeviceType(
+                Devices[Unit]
+            )
             if devicetype:
                 topic = (
                     self.discoverytopic
@@ -749,201 +1871,381 @@ class BasePlugin:
                 )
                 Domoticz.Log("Clearing topic '" + topic + "'")
                 self.mqttClient.Publish(topic, "", 1)
-        self.copyDevices()
-        # TODO: Update subscribed topics
+        if Unit in Devices and "statsname" in Devices[Unit].Options:
+            # Deleted by the user, not created again until restart
+            self.statsUnits[Devices[Unit].Options["statsname"]] = None
+        self.unindexDevice(Unit)
+        self.updateSubscriptions()
+        self.cachedDeviceNames.pop(Unit, None)
+        self.deadlines.pop(Unit, None)
+        self.heldUpdates.pop(Unit, None)
+        self.lastWrites.pop(Unit, None)
+        self.freeUnit = min(self.freeUnit, Unit)
 
     def onHeartbeat(self):
-        Domoticz.Debug("Heartbeating...")
+        logger.debug("Heartbeating...")
 
         # Reconnect if connection has dropped
-        if self.mqttClient.mqttConn is None or (
-            not self.mqttClient.mqttConn.Connecting()
-            and not self.mqttClient.mqttConn.Connected()
-            or not self.mqttClient.isConnected
+        now = time.time()
+        self.mqttClient.onHeartbeat(now)
+
+        # Process discovery configs once the retained message burst is over
+        if self.discoveryBurst is not None and (
+            now - self.lastDiscovery >= self.options["discoveryQuietPeriod"]
+            or now - self.discoveryBurst >= DISCOVERY_BURST_MAX_DURATION
         ):
-            Domoticz.Debug("Reconnecting")
-            self.mqttClient.Open()
-        else:
-            self.mqttClient.Ping()
+            self.flushDiscovery()
 
-        # Timing out sensors
-        # Domoticz.Debug( "OnHeartbeat: Settings " + str( Settings ) )
+        # Continue paced Tasmota configuration refreshes
+        self.processRefreshQueue(now)
 
-        now = datetime.now()
-        update_timeout = int(Settings["SensorTimeout"])
+        # Write changes held back by the minimum update interval
+        self.flushHeldUpdates(now)
 
-        # Domoticz.Debug( "OnHeartbeat: " + str( Devices.items() ) + " " + str( type( Devices ) ) )
+        # Timing out sensors
+        self.checkTimeouts(now)
 
-        for k, device in Devices.items():
-            if self.isMQTTSensor(device):
-                if len(device.LastUpdate) > 0:
-                    # Domoticz.Debug( "OnHeartbeat: Device " + device.Name + ", Last update " + str( device.LastUpdate ) )
+        if (
+            metrics.enabled
+            and now - metrics.windowStart >= self.options["statsInterval"]
+        ):
+            self.publishStats(now)
 
-                    # Workaround of Python issue https://bugs.python.org/issue27400
-                    last_update = None
-                    try:
-                        last_update = datetime.strptime(
-                            device.LastUpdate, "%Y-%m-%d %H:%M:%S"
-                        )
-                    except TypeError:
-                        last_update = datetime.fromtimestamp(
-                            time.mktime(
-                                time.strptime(device.LastUpdate, "%Y-%m-%d %H:%M:%S")
-                            )
-                        )
+        logger.onHeartbeat(now)
 
-                    time_delta = now - last_update
-                    # Domoticz.Debug( "OnHeartbeat: " + device.Name + ", Time delta " + str( time_delta ) + ", Timeout " + str( update_timeout ) + ", Actual " + str( time_delta.total_seconds() / 60 ) )
+        if self.mqttClient.recorder is not None:
+            self.mqttClient.recorder.flush()
 
-                    if (time_delta.total_seconds() / 60) >= update_timeout:
-                        if device.TimedOut == 0:
-                            device.Update(
-                                nValue=device.nValue, sValue=device.sValue, TimedOut=1
-                            )  # , SuppressTriggers=True)
+        if (
+            self.options["snapshotInterval"] > 0
+            and self.snapshotDirty
+            and now - self.lastSnapshot >= self.options["snapshotInterval"]
+        ):
+            self.saveSnapshot()
 
-                            Domoticz.Status(
-                                self.deviceStr(self.getUnit(device))
-                                + ": Offline for more than "
-                                + str(update_timeout)
-                                + " minutes, Setting TimedOut: 1"
-                            )
+    # Returns str(unit) -> [config digest, descriptor state] of the snapshot,
+    # empty if there is no valid one. Plain JSON, so loading it never runs code.
+    def loadSnapshot(self):
+        try:
+            with open(self.snapshotPath, "r", encoding="utf8") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            Domoticz.Log("Snapshot ignored, it is not valid JSON")
+            return {}
+        except OSError as e:
+            Domoticz.Error("Could not load snapshot: " + str(e))
+            return {}
+        if (
+            not isinstance(snapshot, dict)
+            or snapshot.get("version") != SNAPSHOT_VERSION
+            or not isinstance(snapshot.get("devices"), dict)
+        ):
+            Domoticz.Log("Snapshot ignored, it has another format")
+            return {}
+        return snapshot["devices"]
+
+    def saveSnapshot(self):
+        devices = {}
+        for unit, descriptor in self.descriptors.items():
+            if unit in Devices and "config" in Devices[unit].Options:
+                devices[str(unit)] = [
+                    configDigest(Devices[unit].Options["config"]),
+                    descriptor.getSnapshot(),
+                ]
+        snapshot = {"version": SNAPSHOT_VERSION, "devices": devices}
+        # Replace the previous snapshot only once the new one is complete
+        path = self.snapshotPath + ".tmp"
+        try:
+            with open(path, "w", encoding="utf8") as f:
+                json.dump(snapshot, f, separators=(",", ":"))
+            os.replace(path, self.snapshotPath)
+        except (OSError, TypeError, ValueError) as e:
+            Domoticz.Error("Could not save snapshot: " + str(e))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return
+        self.snapshotDirty = False
+        self.lastSnapshot = time.time()
+        logger.debug("Saved snapshot of %d devices", len(devices))
+
+    def publishStats(self, now):
+        gauges = {
+            "devices": len(Devices),
+            "subscriptions": len(self.mqttClient.subscriptions),
+            "pendingDiscovery": len(self.pendingDiscovery),
+            "heldUpdates": len(self.heldUpdates),
+            "refreshQueue": len(self.refreshQueue),
+            "timeoutQueue": len(self.deadlineQueue),
+        }
+        for name, value in self.mqttClient.getQueueMetrics().items():
+            gauges["publishQueue" + name.capitalize()] = value
+        gauges["publishQueue"] = gauges.pop("publishQueueDepth")
+        gauges["pingCount"] = self.mqttClient.pingCount
+        gauges["stallCount"] = self.mqttClient.stallCount
+        if self.mqttClient.rtt is not None:
+            gauges["rtt_ms"] = round(self.mqttClient.rtt * 1000, 1)
+        stats = metrics.snapshot(now, gauges)
+        self.mqttClient.Publish(self.statsTopic, json.dumps(stats))
+        if self.options["statsDevices"]:
+            self.updateStatsDevices(stats)
+
+    # Show statistics as Custom sensor devices, created when missing unless
+    # the user deleted them
+    def updateStatsDevices(self, stats):
+        for statsname, name, axis, path in STATS_DEVICES:
+            if statsname in self.statsUnits and self.statsUnits[statsname] is None:
+                continue
+            unit = self.statsUnits.get(statsname)
+            if unit not in Devices:
+                unit = self.getFreeUnit()
+                Domoticz.Log("Creating statistics device with unit: " + str(unit))
+                Domoticz.Device(
+                    Name=name,
+                    Unit=unit,
+                    TypeName="Custom",
+                    Options={"Custom": "1;" + axis, "statsname": statsname},
+                    Used=self.options["addDiscoveredDeviceUsed"],
+                ).Create()
+                self.statsUnits[statsname] = unit
+                self.cacheDeviceName(unit)
+            value = getPath(stats, path)
+            if value is None:
+                value = 0
+            Devices[unit].Update(nValue=0, sValue=str(value))
+
+    # Returns the number of seconds without update after which unit is timed
+    # out, None if it never times out
+    def getTimeout(self, unit):
+        descriptor = self.descriptors.get(unit)
+        if descriptor is not None and descriptor.expire_after is not None:
+            return descriptor.expire_after
+        if unit in Devices and self.isMQTTSensor(Devices[unit]):
+            return int(Settings["SensorTimeout"]) * 60
+        return None
+
+    # (Re)schedule the time out of unit, counting from lastupdate
+    def scheduleTimeout(self, unit, lastupdate):
+        timeout = self.getTimeout(unit)
+        if timeout is None or lastupdate is None:
+            self.deadlines.pop(unit, None)
+            return
+        deadline = lastupdate + timeout
+        self.deadlines[unit] = deadline
+        # Only queue when earlier than the queued deadline, later deadlines are
+        # re-queued when the queued one is reached
+        if unit not in self.queuedDeadlines or deadline < self.queuedDeadlines[unit]:
+            self.queuedDeadlines[unit] = deadline
+            heapq.heappush(self.deadlineQueue, (deadline, unit))
+
+    # Set TimedOut on all devices whose deadline has passed
+    def checkTimeouts(self, now):
+        while self.deadlineQueue and self.deadlineQueue[0][0] <= now:
+            queued, unit = heapq.heappop(self.deadlineQueue)
+            if self.queuedDeadlines.get(unit) != queued:
+                continue  # Superseded by an earlier entry
+            del self.queuedDeadlines[unit]
+            deadline = self.deadlines.get(unit)
+            if deadline is None:
+                continue
+            if deadline > now:
+                # Updated since queued
+                self.queuedDeadlines[unit] = deadline
+                heapq.heappush(self.deadlineQueue, (deadline, unit))
+                continue
+            del self.deadlines[unit]
+            if unit not in Devices:
+                continue
+            device = Devices[unit]
+            if device.TimedOut == 0:
+                device.Update(
+                    nValue=device.nValue, sValue=device.sValue, TimedOut=1
+                )  # , SuppressTriggers=True)
+                metrics.count("deviceWrites")
+
+                Domoticz.Status(
+                    self.deviceStr(unit)
+                    + ": Offline for more than "
+                    + str(self.getTimeout(unit))
+                    + " seconds, Setting TimedOut: 1"
+                )
 
-                            self.copyDevices()
-                        else:
-                            # Domoticz.Debug( "OnHeartbeat: Device " + device.Name + " already timed out, do nothing" )
-                            pass
+    # Returns device.LastUpdate as seconds since the epoch, None if not set
+    def getLastUpdate(self, device):
+        if len(device.LastUpdate) == 0:
+            return None
+        # Workaround of Python issue https://bugs.python.org/issue27400
+        try:
+            last_update = datetime.strptime(device.LastUpdate, "%Y-%m-%d %H:%M:%S")
+            return time.mktime(last_update.timetuple())
+        except TypeError:
+            return time.mktime(time.strptime(device.LastUpdate, "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
+            return None
 
     # Pull configuration and status from tasmota device
     def refreshConfiguration(self, Topic):
-        Domoticz.Debug("refreshConfiguration for device with topic: '" + Topic + "'")
+        logger.debug("refreshConfiguration for device with topic: '%s'", Topic)
         # Refresh relay / dimmer configuration
-        self.mqttClient.Publish(Topic + "/Status", "11")
+        self.mqttClient.Publish(Topic + "/Status", "11", coalesce=False)
         # Refresh sensor configuration
         # self.mqttClient.Publish(Topic+"/Status",'10')
         # Refresh IP configuration
-        self.mqttClient.Publish(Topic + "/Status", "5")
+        self.mqttClient.Publish(Topic + "/Status", "5", coalesce=False)
 
     # Returns list of topics to subscribe to
     def getTopics(self):
-        topics = set()
-        for key, Device in Devices.items():
-            # Domoticz.Debug("getTopics: '" + str(Device.Options) +"'")
-            try:
-                configdict = json.loads(Device.Options["config"])
-                # Domoticz.Debug("getTopics: '" + str(configdict) +"'")
-                for key, value in configdict.items():
-                    # Domoticz.Debug("getTopics: key:'" + str(key) +"' value: '" + str(value) + "'")
-                    try:
-                        # if key.endswith('_topic'):
-                        if (
-                            key == "availability_topic"
-                            or key == "state_topic"
-                            or key == "brightness_state_topic"
-                            or key == "rgb_state_topic"
-                            or key == "color_temp_state_topic"
-                            or key == "position_topic"
-                        ):
-                            topics.add(value)
-                    except (TypeError) as e:
-                        Domoticz.Error("getTopics: Error: " + str(e))
-                        pass
-                if "tasmota_tele_topic" in configdict:
-                    # Subscribe to all Tasmota state topics
-                    state_topic = re.sub(
-                        r"^tele\/", "stat/", configdict["tasmota_tele_topic"]
-                    )  # Replace tele with stat
-                    state_topic = re.sub(
-                        r"\/tele\/", "/stat/", state_topic
-                    )  # Replace tele with stat
-                    state_topic = re.sub(
-                        r"\/STATE", "/#", state_topic
-                    )  # Replace '/STATE' with /#
-                    topics.add(state_topic)
-            except (ValueError, KeyError, TypeError) as e:
-                Domoticz.Error("getTopics: Error: " + str(e))
-                pass
-        topics.add(self.discoverytopic + "/#")
-        Domoticz.Debug("getTopics: '" + str(topics) + "'")
+        topics = set(self.subscriptionIndex)
+        for component in DISCOVERY_COMPONENTS:
+            topic = self.discoverytopic + "/" + component + "/#"
+            if not self.ignoredtopics.covers(topic):
+                topics.add(topic)
+        logger.debug("getTopics: '%s'", topics)
         return list(topics)
 
-    # Returns list of matching devices
-    def getDevices(
+    # Returns list of descriptors of the devices referencing topic
+    def getDescriptors(self, topic):
+        descriptors = []
+        for unit in self.topicIndex.get(topic, ()):
+            if unit in Devices:
+                descriptors.append(self.descriptors[unit])
+        return descriptors
+
+    # Compile the device descriptor of unit and add it to the topic routing
+    # index, replacing any previous entries. Parses Options["config"] unless
+    # the already decoded config or a restored descriptor is passed.
+    def indexDevice(self, unit, config=None, descriptor=None):
+        self.unindexDevice(unit)
+        self.snapshotDirty = True
+        if unit not in Devices:
+            return None
+        devicename = Devices[unit].Options.get("devicename")
+        if devicename:
+            self.devicenameUnits[devicename] = unit
+            self.unitDevicenames[unit] = devicename
+            if "fingerprint" in Devices[unit].Options:
+                self.fingerprints[devicename] = Devices[unit].Options["fingerprint"]
+        if descriptor is None:
+            try:
+                if config is None:
+                    descriptor = DeviceDescriptor.fromDevice(unit, Devices[unit])
+                else:
+                    descriptor = DeviceDescriptor(
+                        unit,
+                        Devices[unit].Options.get("devicename", ""),
+                        config,
+                        Devices[unit].Options.get("component", ""),
+                    )
+            except (ValueError, KeyError, TypeError) as e:
+                return None
+        self.descriptors[unit] = descriptor
+        self.routeDevice(descriptor)
+        for topic in descriptor.topics:
+            self.topicIndex.setdefault(topic, set()).add(unit)
+        for topic in descriptor.subscriptions:
+            units = self.subscriptionIndex.get(topic)
+            if units is None:
+                if self.ignoredtopics.covers(topic):
+                    continue  # The broker would only send ignored messages
+                units = self.subscriptionIndex[topic] = set()
+                if topic in self.removedSubscriptions:
+                    self.removedSubscriptions.discard(topic)
+                else:
+                    self.addedSubscriptions.add(topic)
+            units.add(unit)
+        return descriptor
+
+    # Select the message handlers for the roles each topic plays for the device
+    def routeDevice(self, descriptor):
+        device = Devices[descriptor.unit]
+        sensor = self.isMQTTSensor(device)
+        # Minimum update interval by devicename, then by component
+        intervals = self.options["minUpdateIntervals"]
+        component = descriptor.component or self.getDeviceType(device)
+        descriptor.updateInterval = intervals.get(
+            descriptor.devicename,
+            intervals.get(component, self.options["minUpdateInterval"]),
+        )
+        for topic, roles in descriptor.roles.items():
+            handlers = []
+            # Binary sensors are updated as switches, from payload_on/off
+            if not sensor and roles & SWITCH_ROLES:
+                handlers.append(self.updateSwitch)
+            if "availability_topic" in roles:
+                handlers.append(self.updateAvailability)
+            if sensor and roles & SENSOR_ROLES:
+                handlers.append(self.updateSensor)
+            if "tasmota_tele_topic" in roles:
+                handlers.append(self.updateTasmotaStatus)
+            descriptor.handlers[topic] = tuple(handlers)
+
+    # Remove unit from the topic routing index and drop its descriptor
+    def unindexDevice(self, unit):
+        self.snapshotDirty = True
+        devicename = self.unitDevicenames.pop(unit, None)
+        if self.devicenameUnits.get(devicename) == unit:
+            del self.devicenameUnits[devicename]
+            self.fingerprints.pop(devicename, None)
+        descriptor = self.descriptors.pop(unit, None)
+        if descriptor is None:
+            return
+        for topic in descriptor.topics:
+            units = self.topicIndex.get(topic)
+            if units is not None:
+                units.discard(unit)
+                if not units:
+                    del self.topicIndex[topic]
+        for topic in descriptor.subscriptions:
+            units = self.subscriptionIndex.get(topic)
+            if units is not None:
+                units.discard(unit)
+                if not units:
+                    del self.subscriptionIndex[topic]
+                    if topic in self.addedSubscriptions:
+                        self.addedSubscriptions.discard(topic)
+                    else:
+                        self.removedSubscriptions.add(topic)
+
+    # Send subscription changes caused by (un)indexing devices to the broker
+    def updateSubscriptions(self):
+        if self.bulkDiscovery:
+            return  # Sent once bulk discovery is done
+        if self.removedSubscriptions:
+            self.mqttClient.Unsubscribe(self.removedSubscriptions)
+            self.removedSubscriptions = set()
+        if self.addedSubscriptions:
+            self.mqttClient.Subscribe(self.addedSubscriptions)
+            self.addedSubscriptions = set()
+
+    # Returns first unused 'Unit'
+    def getFreeUnit(self):
+        while self.freeUnit in Devices:
+            self.freeUnit += 1
+        return self.freeUnit
+
+    def makeDevice(
         self,
-        key="",
-        configkey="",
-        hasconfigkey="",
-        value="",
-        config="",
-        topic="",
-        type="",
-        channel="",
+        devicename,
+        component,
+        TypeName,
+        switchTypeDomoticz,
+        config,
+        fingerprint=None,
     ):
-        Domoticz.Debug(
-            "getDevices key: '"
-            + key
-            + "' configkey: '"
-            + configkey
-            + "' hasconfigkey: '"
-            + hasconfigkey
-            + "' value: '"
-            + value
-            + "' config: '"
-            + config
-            + "' topic: '"
-            + topic
-            + "'"
-        )
-        matchingDevices = set()
-        if key != "":
-            for k, Device in Devices.items():
-                try:
-                    if Device.Options[key] == value:
-                        matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
-        if configkey != "":
-            for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options["config"])
-                    if configdict[configkey] == value:
-                        matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
-        elif hasconfigkey != "":
-            for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options["config"])
-                    if hasconfigkey in configdict:
-                        matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
-        elif config != "":
-            for k, Device in Devices.items():
-                try:
-                    if Device.Options["config"] == config:
-                        matchingDevices.add(Device)
-                except KeyError:
-                    pass
-        elif topic != "":
-            for k, Device in Devices.items():
-                try:
-                    configdict = json.loads(Device.Options["config"])
-                    for key, value in configdict.items():
-                        if value == topic:
-                            matchingDevices.add(Device)
-                except (ValueError, KeyError) as e:
-                    pass
-        Domoticz.Debug("getDevices found " + str(len(matchingDevices)) + " devices")
-        return list(matchingDevices)
-
-    def makeDevice(self, devicename, TypeName, switchTypeDomoticz, config):
-        iUnit = next(
-            filterfalse(set(Devices).__contains__, count(1))
-        )  # First unused 'Unit'
+        iUnit = self.getFreeUnit()
 
         Domoticz.Log("Creating device with unit: " + str(iUnit))
 
-        Options = {"config": json.dumps(config), "devicename": devicename}
+        Options = {
+            "config": json.dumps(config),
+            "devicename": devicename,
+            "component": component,
+        }
+        if fingerprint is not None:
+            Options["fingerprint"] = fingerprint
         # DeviceName = topic+' - '+type
         DeviceName = config["name"]
         Domoticz.Device(
@@ -954,15 +2256,31 @@ class BasePlugin:
             Options=Options,
             Used=self.options["addDiscoveredDeviceUsed"],
         ).Create()
+        self.indexDevice(iUnit, config)
+        self.cacheDeviceName(iUnit)
+        self.scheduleTimeout(iUnit, time.time())
 
-    def makeDeviceRaw(self, devicename, Type, Subtype, switchTypeDomoticz, config):
-        iUnit = next(
-            filterfalse(set(Devices).__contains__, count(1))
-        )  # First unused 'Unit'
+    def makeDeviceRaw(
+        self,
+        devicename,
+        component,
+        Type,
+        Subtype,
+        switchTypeDomoticz,
+        config,
+        fingerprint=None,
+    ):
+        iUnit = self.getFreeUnit()
 
         Domoticz.Log("Creating device with unit: " + str(iUnit))
 
-        Options = {"config": json.dumps(config), "devicename": devicename}
+        Options = {
+            "config": json.dumps(config),
+            "devicename": devicename,
+            "component": component,
+        }
+        if fingerprint is not None:
+            Options["fingerprint"] = fingerprint
         # DeviceName = topic+' - '+type
         DeviceName = config["name"]
         Domoticz.Device(
@@ -974,60 +2292,67 @@ class BasePlugin:
             Options=Options,
             Used=self.options["addDiscoveredDeviceUsed"],
         ).Create()
+        self.indexDevice(iUnit, config)
+        self.cacheDeviceName(iUnit)
+        self.scheduleTimeout(iUnit, time.time())
 
     def isDeviceIgnored(self, config):
-        ignore = False
-        for ignoredtopic in self.ignoredtopics:
-            for key, value in config.items():
-                if key.endswith("_topic"):
-                    if value.startswith(ignoredtopic):
-                        ignore = True
-                        Domoticz.Debug("isDeviceIgnored: " + str(ignore))
-        return ignore
-
+        for key, value in config.items():
+            if key.endswith("_topic") and isinstance(value, str):
+                if self.ignoredtopics.matches(value):
+                    logger.debug("isDeviceIgnored: %s", value)
+                    return True
+        return False
+
+    # A Tasmota device has the tele/LWT topic of a node as availability topic
+    # and its tele/STATE, stat/RESULT or cmnd/POWER topic as state topic
     def addTasmotaTopics(self, config):
-        isTasmota = False
-        # TODO: Something smarter to detect Tasmota device
-        try:
-            # if "/cmnd/" in config["command_topic"] and "/POWER" in config["command_topic"] and "/tele/" in config["availability_topic"] and "/LWT" in config["availability_topic"]:
-            if (
-                (
-                    (
-                        "/stat/" in config["state_topic"]
-                        and "/RESULT" in config["state_topic"]
-                    )
-                    or (
-                        "/cmnd/" in config["state_topic"]
-                        and "/POWER" in config["state_topic"]
-                    )
-                    or (
-                        "/tele/" in config["state_topic"]
-                        and "/STATE" in config["state_topic"]
-                    )
-                )
-                and "/tele/" in config["availability_topic"]
-                and "/LWT" in config["availability_topic"]
-            ):
-                isTasmota = True
-
-            Domoticz.Debug("addTasmotaTopics: isTasmota: " + str(isTasmota))
-            if isTasmota:
-                statetopic = config["availability_topic"].replace("/LWT", "/STATE")
-                Domoticz.Debug("addTasmotaTopics: statetopic: " + statetopic)
-                config["tasmota_tele_topic"] = statetopic
-        except (ValueError, KeyError) as e:
-            pass
+        availability_topic = config.get("availability_topic")
+        state_topic = config.get("state_topic")
+        if not isinstance(availability_topic, str) or not isinstance(state_topic, str):
+            return
+        node = TasmotaNode.parse(availability_topic, "LWT")
+        isTasmota = node is not None and (
+            state_topic == node.teleTopic
+            or state_topic == node.topic("stat", "RESULT")
+            or state_topic.startswith(node.topic("cmnd", "POWER"))
+        )
+        logger.debug("addTasmotaTopics: isTasmota: %s", isTasmota)
+        if isTasmota:
+            logger.debug("addTasmotaTopics: statetopic: %s", node.teleTopic)
+            config["tasmota_tele_topic"] = sys.intern(node.teleTopic)
 
     # =============================================================DEVICE CONFIG==============================================================
-    def updateDeviceSettings(self, devicename, devicetype, config):
-        Domoticz.Debug(
-            "updateDeviceSettings: devicename: '"
-            + devicename
-            + "' devicetype: '"
-            + devicetype
-            + "' config: '"
-            + str(config)
-            + "'"
+    def discoverDevice(self, devicename, devicetype, config, fingerprint=None):
+        if self.discoveryBurst is None:
+            self.updateDeviceSettings(devicename, devicetype, config, fingerprint)
+        else:
+            # Buffer until the burst goes quiet, last config wins
+            self.pendingDiscovery[devicename] = (devicetype, config, fingerprint)
+            self.lastDiscovery = time.time()
+
+    # Add / update all buffered devices in one pass, then subscribe once
+    def flushDiscovery(self):
+        pending = self.pendingDiscovery
+        self.pendingDiscovery = {}
+        self.discoveryBurst = None
+        Domoticz.Log("Processing " + str(len(pending)) + " discovered devices")
+        self.bulkDiscovery = True
+        try:
+            for devicename, (devicetype, config, fingerprint) in pending.items():
+                self.updateDeviceSettings(devicename, devicetype, config, fingerprint)
+        finally:
+            self.bulkDiscovery = False
+        self.updateSubscriptions()
+
+    # fingerprint identifies the raw config payload, stored in Options to skip
+    # the same payload next time
+    def updateDeviceSettings(self, devicename, devicetype, config, fingerprint=None):
+        logger.debug(
+            "updateDeviceSettings: devicename: '%s' devicetype: '%s' config: '%s'",
+            devicename,
+            devicetype,
+            config,
         )
 
         TypeName = ""
@@ -1039,7 +2364,7 @@ class BasePlugin:
             or "color_temp_command_topic" in config
             or "rgb_command_topic" in config
         ):
-            Domoticz.Debug("updateDeviceSettings: devicetype == 'light'")
+            logger.debug("updateDeviceSettings: devicetype == 'light'")
             switchTypeDomoticz = 7  # Dimmer
             rgbww = 0
             if "white_value_command_topic" in config:
@@ -1067,7 +2392,7 @@ class BasePlugin:
         elif (
             devicetype == "switch" or devicetype == "light"
         ):  # Switch or light without dimming/color/color temperature
-            Domoticz.Debug("updateDeviceSettings: devicetype == 'switch'")
+            logger.debug("updateDeviceSettings: devicetype == 'switch'")
             TypeName = "Switch"
             Type = 0xF4  # pTypeGeneralSwitch
             Subtype = 0x49  # sSwitchGeneralSwitch
@@ -1088,7 +2413,7 @@ class BasePlugin:
                 15  # STYPE_Blinds Venetian-type  with UP / DOWN / STOP   buttons
             )
         elif devicetype == "sensor":
-            Domoticz.Debug("updateDeviceSettings: devicetype == 'sensor'")
+            logger.debug("updateDeviceSettings: devicetype == 'sensor'")
             if "device_class" in config:
                 if config["device_class"] == "temperature":
                     Type = 0x50  # pTypeTemp RFXTrx.h
@@ -1097,8 +2422,8 @@ class BasePlugin:
                     Type = 0x52  # pTypeTempHum
                     Subtype = 0x01  # La Crosse
 
-        matchingDevices = self.getDevices(key="devicename", value=devicename)
-        if len(matchingDevices) == 0:
+        unit = self.devicenameUnits.get(devicename)
+        if unit not in Devices:
             Domoticz.Log(
                 "updateDeviceSettings: Did not find device with key='devicename', value = '"
                 + devicename
@@ -1111,28 +2436,38 @@ class BasePlugin:
             if TypeName != "":
                 self.addTasmotaTopics(config)
                 if not self.isDeviceIgnored(config):
-                    self.makeDevice(devicename, TypeName, switchTypeDomoticz, config)
+                    self.makeDevice(
+                        devicename,
+                        devicetype,
+                        TypeName,
+                        switchTypeDomoticz,
+                        config,
+                        fingerprint,
+                    )
                     # Update subscription list
-                    self.mqttClient.Subscribe(self.getTopics())
+                    self.updateSubscriptions()
             elif Type != 0:
                 self.addTasmotaTopics(config)
                 if not self.isDeviceIgnored(config):
                     self.makeDeviceRaw(
-                        devicename, Type, Subtype, switchTypeDomoticz, config
+                        devicename,
+                        devicetype,
+                        Type,
+                        Subtype,
+                        switchTypeDomoticz,
+                        config,
+                        fingerprint,
                     )
                     # Update subscription list
-                    self.mqttClient.Subscribe(self.getTopics())
+                    self.updateSubscriptions()
         else:
-            # TODO: What do if len(matchingDevices) > 1?
-            device = matchingDevices[0]
+            device = Devices[unit]
             self.addTasmotaTopics(config)
             oldconfigdict = {}
-            try:
-                oldconfigdict = json.loads(device.Options["config"])
-            except (ValueError, KeyError, TypeError) as e:
-                pass
+            if unit in self.descriptors:
+                oldconfigdict = self.descriptors[unit].getConfig(device)
             # Correction for subsequent messages
-            if self.isMQTTSensor(device):
+            if self.isMQTTSensor(device) and "value_template" in oldconfigdict:
                 config["value_template"] = oldconfigdict["value_template"]
                 if device.Type == 0x52 and Type == 0x50:
                     Type = 0  # Reset, no change
@@ -1145,7 +2480,7 @@ class BasePlugin:
             ):
                 Domoticz.Log(
                     "updateDeviceSettings: "
-                    + self.deviceStr(self.getUnit(device))
+                    + self.deviceStr(unit)
                     + ": Device settings not matching, updating Type, SubType, Switchtype and Options['config']"
                 )
                 Domoticz.Log(
@@ -1170,6 +2505,9 @@ class BasePlugin:
                 sValue = device.sValue
                 Options = dict(device.Options)
                 Options["config"] = json.dumps(config)
+                Options["component"] = devicetype
+                if fingerprint is not None:
+                    Options["fingerprint"] = fingerprint
                 device.Update(
                     nValue=nValue,
                     sValue=sValue,
@@ -1179,7 +2517,29 @@ class BasePlugin:
                     Options=Options,
                     SuppressTriggers=True,
                 )
-                self.copyDevices()
+                self.indexDevice(unit, config)
+                self.updateSubscriptions()
+                self.scheduleTimeout(unit, time.time())
+            elif (
+                fingerprint is not None and "fingerprint" not in device.Options
+            ) or device.Options.get("component") != devicetype:
+                # Config unchanged, store the fingerprint and component of
+                # devices created before they were stored
+                Options = dict(device.Options)
+                Options["component"] = devicetype
+                if fingerprint is not None:
+                    Options["fingerprint"] = fingerprint
+                    self.fingerprints[devicename] = fingerprint
+                device.Update(
+                    nValue=device.nValue,
+                    sValue=device.sValue,
+                    Options=Options,
+                    SuppressTriggers=True,
+                )
+                descriptor = self.descriptors.get(unit)
+                if descriptor is not None:
+                    descriptor.component = devicetype
+                    self.routeDevice(descriptor)
 
     # ==========================================================UPDATE STATUS from MQTT==============================================================
     def isMQTTSensor(self, Device):
@@ -1189,10 +2549,112 @@ class BasePlugin:
             (Device.SubType == 0x05) or (Device.SubType == 0x01)
         )  # La Cross Temp_Hum combined
 
-    def updateSensor(self, device, topic, message):
-        Domoticz.Debug(
-            "updateSensor topic: '" + topic + "' message: '" + str(message) + "'"
-        )
+    # Discovery component of a device, derived from its Domoticz type
+    def getDeviceType(self, Device):
+        devicetype = ""
+        if (
+            Device.Type == 0xF4
+            and Device.SubType == 0x49  # pTypeGeneralSwitch
+            and Device.SwitchType == 0  # sSwitchGeneralSwitch
+        ):  # OnOff
+            devicetype = "switch"
+        elif (
+            Device.Type == 0xF4
+            and Device.SubType == 0x49  # pTypeGeneralSwitch
+            and Device.SwitchType == 7  # sSwitchGeneralSwitch
+        ):  # Dimmer
+            devicetype = "light"
+        elif Device.Type == 0xF1:  # pTypeColorSwitch
+            devicetype = "light"
+        elif (
+            Device.Type == 0xF4
+            and Device.SubType == 0x49  # pTypeGeneralSwitch
+            and (  # sSwitchGeneralSwitch
+                (Device.SwitchType == 3)
+                or (Device.SwitchType == 15)  # Blind (up/down buttons)
+                or (  # Venetian blinds EU (up/down/stop buttons)
+                    Device.SwitchType == 13
+                )
+            )
+        ):  # Blinds Percentage
+            devicetype = "blinds"
+        elif (
+            Device.Type == 0xF4
+            and Device.SubType == 0x49  # pTypeGeneralSwitch
+            and Device.SwitchType == 9  # sSwitchGeneralSwitch
+        ):  # STYPE_PushOn
+            devicetype = "binary_sensor"
+        elif self.isMQTTSensor(Device):
+            devicetype = "sensor"
+        return devicetype
+
+    # Merge device field changes made while handling a message, they are
+    # written with a single Update by flushUpdates. Triggers are suppressed
+    # only if all changes to the device suppress them.
+    def queueUpdate(self, unit, suppressTriggers, **fields):
+        pending = self.pendingUpdates.get(unit)
+        if pending is None:
+            self.pendingUpdates[unit] = [fields, suppressTriggers]
+        else:
+            pending[0].update(fields)
+            pending[1] = pending[1] and suppressTriggers
+
+    # Returns (nValue, sValue) the device will have once the changes queued or
+    # held for it are written, to compare new values against
+    def getLatestValues(self, unit, device):
+        nValue = device.nValue
+        sValue = device.sValue
+        for changes in (self.heldUpdates.get(unit), self.pendingUpdates.get(unit)):
+            if changes is not None:
+                nValue = changes[0].get("nValue", nValue)
+                sValue = changes[0].get("sValue", sValue)
+        return nValue, sValue
+
+    # Devices with a minimum update interval are written at most once per
+    # interval, changes within the interval are held and merged until the
+    # interval is over so the last value is always written
+    def flushUpdates(self):
+        now = time.time()
+        for unit, (fields, suppressTriggers) in self.pendingUpdates.items():
+            descriptor = self.descriptors.get(unit)
+            if descriptor is not None and descriptor.updateInterval > 0:
+                held = self.heldUpdates.pop(unit, None)
+                if held is not None:
+                    held[0].update(fields)
+                    fields = held[0]
+                    suppressTriggers = held[1] and suppressTriggers
+                if now - self.lastWrites.get(unit, 0) < descriptor.updateInterval:
+                    self.heldUpdates[unit] = [fields, suppressTriggers]
+                    continue
+                self.lastWrites[unit] = now
+            self.writeUpdate(unit, fields, suppressTriggers)
+        self.pendingUpdates = {}
+
+    # Write held changes of devices whose minimum update interval is over
+    def flushHeldUpdates(self, now):
+        for unit in list(self.heldUpdates):
+            descriptor = self.descriptors.get(unit)
+            if (
+                descriptor is None
+                or now - self.lastWrites.get(unit, 0) >= descriptor.updateInterval
+            ):
+                fields, suppressTriggers = self.heldUpdates.pop(unit)
+                self.lastWrites[unit] = now
+                self.writeUpdate(unit, fields, suppressTriggers)
+
+    def writeUpdate(self, unit, fields, suppressTriggers):
+        if unit not in Devices:
+            return
+        device = Devices[unit]
+        nValue = fields.pop("nValue", device.nValue)
+        sValue = fields.pop("sValue", device.sValue)
+        if suppressTriggers:
+            fields["SuppressTriggers"] = True
+        device.Update(nValue=nValue, sValue=sValue, **fields)
+        metrics.count("deviceWrites")
+
+    def updateSensor(self, device, descriptor, topic, roles, message):
+        logger.debug("updateSensor topic: '%s' message: '%s'", topic, message)
 
         nValue = device.nValue  # 0
         sValue = device.sValue  # -1
@@ -1203,24 +2665,20 @@ class BasePlugin:
         result = False
 
         try:
-            devicetopics = []
-            configdict = json.loads(device.Options["config"])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
             if (
-                "state_topic" in devicetopics or "tasmota_tele_topic" in devicetopics
-            ):  # Switch status is present in Tasmota tele/STAT message
-                if "state_topic" in devicetopics:
-                    Domoticz.Debug(
-                        "UpdateSensor: Got state_topic " + configdict["state_topic"]
+                "state_topic" in roles or "tasmota_tele_topic" in roles
+            ) and descriptor.value_template is not None:
+                # Switch status is present in Tasmota tele/STAT message
+                if "state_topic" in roles:
+                    logger.debug(
+                        "UpdateSensor: Got state_topic %s", descriptor.state_topic
                     )
-                if "tasmota_tele_topic" in devicetopics:
-                    Domoticz.Debug(
-                        "UpdateSensor: Got tasmota_tele_topic "
-                        + configdict["tasmota_tele_topic"]
+                if "tasmota_tele_topic" in roles:
+                    logger.debug(
+                        "UpdateSensor: Got tasmota_tele_topic %s",
+                        descriptor.tasmota_tele_topic,
                     )
-                if "tasmota_tele_topic" in devicetopics:
+                if "tasmota_tele_topic" in roles:
                     isTeleTopic = (
                         True  # Suppress device triggers for periodic tele/STAT message
                     )
@@ -1228,54 +2686,32 @@ class BasePlugin:
                 if self.isMQTTSensor(device):
                     result = True
 
-                    Domoticz.Debug(
-                        "updateSensor: value_template '"
-                        + configdict["value_template"]
-                        + "'"
-                    )
-                    value_template = "Temperature"
-
-                    msg = message
-                    # Domoticz.Debug("updateSensor: MSG: " + str(msg))
-
-                    m = re.match(
-                        r"^{{[\s]*value_json\.*(.+)[\s]*}}$",
-                        configdict["value_template"],
-                    )
-
-                    if m != None:
-                        value_template = m.group(1).strip().strip("'").strip('"')
-                        m = re.split(r"\[(.*?)\]", value_template)
-
-                        # Domoticz.Debug("updateSensor: value_template '" + value_template + "'")
-
-                        if m != None:
-                            # Domoticz.Debug( "updateSensor: M1:" + str( m ))
-                            if len(m) > 1:
-                                value_template = (
-                                    m[len(m) - 2].strip().strip("'").strip('"')
-                                )
-                                # Domoticz.Debug("updateSensor: value_template '" + value_template + "'")
-                                m = m[1 : len(m) - 2]
-                                # Domoticz.Debug("updateSensor: M2:" + str( m ) )
-                                for value in m:
-                                    val = value.strip().strip("'").strip('"')
-                                    # Domoticz.Debug("updateSensor: VAL: " + str(val))
-                                    if len(val) > 0:
-                                        msg = msg[val]
-                                        # Domoticz.Debug("updateSensor: MSG: " + str(msg))
-
-                    Domoticz.Debug(
-                        "updateSensor: Matched template '"
-                        + value_template
-                        + "', Message: "
-                        + str(msg)
+                    template = descriptor.value_template
+                    logger.debug("updateSensor: value_template '%s'", template.template)
+
+                    if template.path is not None:
+                        value_template = template.key
+                        msg = template.parent(message)
+                        value = template.render(message)
+                    elif template.valid:  # {{ value }}
+                        value_template = ""
+                        msg = message
+                        value = template.render(message)
+                    else:
+                        value_template = "Temperature"
+                        msg = message
+                        value = getPath(message, (value_template,))
+
+                    logger.debug(
+                        "updateSensor: Matched template '%s', Message: %s",
+                        value_template,
+                        msg,
                     )
 
                     temp = None
                     try:
-                        temp = float(msg[value_template])
-                    except (ValueError, KeyError, TypeError):
+                        temp = float(value)
+                    except (ValueError, TypeError):
                         pass
 
                     hum = None
@@ -1298,15 +2734,12 @@ class BasePlugin:
                     except (ValueError, KeyError, TypeError):
                         pass
 
-                    Domoticz.Debug(
-                        "updateSensor: Temperature: "
-                        + str(temp)
-                        + ", Humidity: "
-                        + str(hum)
-                        + ", Battery level: "
-                        + str(bat)
-                        + ", RSSI: "
-                        + str(rss)
+                    logger.debug(
+                        "updateSensor: Temperature: %s, Humidity: %s, Battery level: %s, RSSI: %s",
+                        temp,
+                        hum,
+                        bat,
+                        rss,
                     )
 
                     if temp != None:
@@ -1323,41 +2756,41 @@ class BasePlugin:
 
                             sValue = sValue + ";" + str(hum) + ";" + str(wet)
 
-        except (ValueError, KeyError) as e:
+        except (ValueError, KeyError, TypeError) as e:
             pass
 
         if updatedevice:
             # Do not update if we got Tasmota periodic state update and state has not changed
-            if not isTeleTopic or nValue != device.nValue or sValue != device.sValue:
-                Domoticz.Log(
-                    "updateSensor: "
-                    + self.deviceStr(self.getUnit(device))
-                    + ": Topic: '"
-                    + str(topic)
-                    + " 'Setting nValue: "
-                    + str(device.nValue)
-                    + "->"
-                    + str(nValue)
-                    + ", sValue: '"
-                    + str(device.sValue)
-                    + "'->'"
-                    + str(sValue)
-                    + "'"
+            if not isTeleTopic or (nValue, sValue) != self.getLatestValues(
+                descriptor.unit, device
+            ):
+                logger.event(
+                    "updates",
+                    "devices",
+                    descriptor.unit,
+                    "updateSensor: %s: Topic: '%s 'Setting nValue: %s->%s, sValue: '%s'->'%s'",
+                    LazyStr(self.deviceStr, descriptor.unit),
+                    topic,
+                    device.nValue,
+                    nValue,
+                    device.sValue,
+                    sValue,
                 )
 
-                device.Update(
+                self.queueUpdate(
+                    descriptor.unit,
+                    False,
                     nValue=nValue,
                     sValue=sValue,
                     BatteryLevel=bat,
                     SignalLevel=rss,
                     TimedOut=0,
                 )
-
-                self.copyDevices()
+                self.scheduleTimeout(descriptor.unit, time.time())
 
         return result
 
-    def updateSwitch(self, device, topic, message):
+    def updateSwitch(self, device, descriptor, topic, roles, message):
         # Domoticz.Debug("updateSwitch topic: '" + topic + "' switchNo: " + str(switchNo) + " key: '" + key + "' message: '" + str(message) + "'")
         nValue = device.nValue  # 0
         sValue = device.sValue  # -1
@@ -1371,178 +2804,154 @@ class BasePlugin:
             pass
 
         try:
-            devicetopics = []
-            configdict = json.loads(device.Options["config"])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
             if (
-                "state_topic" in devicetopics or "tasmota_tele_topic" in devicetopics
+                "state_topic" in roles or "tasmota_tele_topic" in roles
             ):  # Switch status is present in Tasmota tele/STAT message
-                if "state_topic" in devicetopics:
-                    Domoticz.Debug("Got state_topic")
-                if "tasmota_tele_topic" in devicetopics:
-                    Domoticz.Debug("Got tasmota_tele_topic")
-                if "tasmota_tele_topic" in devicetopics:
+                if "state_topic" in roles:
+                    logger.debug("Got state_topic")
+                if "tasmota_tele_topic" in roles:
+                    logger.debug("Got tasmota_tele_topic")
+                if "tasmota_tele_topic" in roles:
                     isTeleTopic = (
                         True  # Suppress device triggers for periodic tele/STAT message
                     )
-                if "value_template" in configdict:
-                    m = re.match(
-                        r"^{{value_json\.(.+)}}$", configdict["value_template"]
-                    )
-                    if m:
-                        value_template = m.group(1)
-                        Domoticz.Debug(
-                            "updateSwitch: value_template: '" + value_template + "'"
+                if descriptor.value_template is not None:
+                    template = descriptor.value_template
+                    if template.valid:
+                        logger.debug(
+                            "updateSwitch: value_template: '%s'", template.template
                         )
-                        if value_template in message:
-                            Domoticz.Debug(
-                                "updateSwitch: message[value_template]: '"
-                                + message[value_template]
-                                + "'"
+                        payload = template.render(message)
+                        if payload is not None:
+                            logger.debug(
+                                "updateSwitch: message[value_template]: '%s'", payload
                             )
-                            payload = message[value_template]
                             if (
-                                "payload_off" in configdict
-                                and payload == configdict["payload_off"]
+                                descriptor.payload_off is not None
+                                and payload == descriptor.payload_off
                             ):
                                 updatedevice = True
                                 nValue = 0
                             if (
-                                "payload_on" in configdict
-                                and payload == configdict["payload_on"]
+                                descriptor.payload_on is not None
+                                and payload == descriptor.payload_on
                             ):
                                 updatedevice = True
                                 nValue = 1
                         else:
-                            Domoticz.Debug("updateSwitch: message[value_template]: '-'")
+                            logger.debug("updateSwitch: message[value_template]: '-'")
                     else:
-                        Domoticz.Debug(
-                            "updateSwitch: unsupported value_template: '"
-                            + configdict["value_template"]
-                            + "'"
+                        logger.debug(
+                            "updateSwitch: unsupported value_template: '%s'",
+                            template.template,
                         )
                 else:
-                    Domoticz.Debug("updateSwitch: No value_template")
+                    logger.debug("updateSwitch: No value_template")
                     payload = message
                     if (
                         (
-                            "payload_off" in configdict
-                            and payload == configdict["payload_off"]
+                            descriptor.payload_off is not None
+                            and payload == descriptor.payload_off
                         )
                         or (
-                            "state_open" in configdict
-                            and payload == configdict["state_open"]
+                            descriptor.state_open is not None
+                            and payload == descriptor.state_open
                         )
-                        or "payload_off" not in configdict
-                        and "state_open" not in configdict
+                        or descriptor.payload_off is None
+                        and descriptor.state_open is None
                         and payload == "OFF"
                     ):
                         updatedevice = True
                         nValue = 0
                     if (
                         (
-                            "payload_on" in configdict
-                            and payload == configdict["payload_on"]
+                            descriptor.payload_on is not None
+                            and payload == descriptor.payload_on
                         )
                         or (
-                            "state_close" in configdict
-                            and payload == configdict["state_close"]
+                            descriptor.state_close is not None
+                            and payload == descriptor.state_close
                         )
-                        or "payload_on" not in configdict
-                        and "state_close" not in configdict
+                        or descriptor.payload_on is None
+                        and descriptor.state_close is None
                         and payload == "ON"
                     ):
                         updatedevice = True
                         nValue = 1
                     if (
                         (
-                            "payload_stop" in configdict
-                            and payload == configdict["payload_stop"]
+                            descriptor.payload_stop is not None
+                            and payload == descriptor.payload_stop
                         )
                         or (
-                            "state_stop" in configdict
-                            and payload == configdict["state_stop"]
+                            descriptor.state_stop is not None
+                            and payload == descriptor.state_stop
                         )
-                        or "payload_stop" not in configdict
-                        and "state_stop" not in configdict
+                        or descriptor.payload_stop is None
+                        and descriptor.state_stop is None
                         and payload == "STOP"
                     ):
                         updatedevice = True
                         nValue = 17  # state = STOP  in blinds
-                    Domoticz.Debug("updateSwitch: nValue: '" + str(nValue) + "'")
-            if "brightness_state_topic" in devicetopics:
-                Domoticz.Debug("updateSwitch: Got brightness_state_topic")
-                if "brightness_value_template" in configdict:
-                    m = re.match(
-                        r"^{{value_json\.(.+)}}$",
-                        configdict["brightness_value_template"],
-                    )
-                    if m:
-                        brightness_value_template = m.group(1)
-                        Domoticz.Debug(
-                            "updateSwitch: brightness_value_template: '"
-                            + brightness_value_template
-                            + "'"
+                    logger.debug("updateSwitch: nValue: '%s'", nValue)
+            if "brightness_state_topic" in roles:
+                logger.debug("updateSwitch: Got brightness_state_topic")
+                if descriptor.brightness_value_template is not None:
+                    template = descriptor.brightness_value_template
+                    if template.valid:
+                        logger.debug(
+                            "updateSwitch: brightness_value_template: '%s'",
+                            template.template,
                         )
-                        if brightness_value_template in message:
-                            Domoticz.Debug(
-                                "updateSwitch: message[brightness_value_template]: '"
-                                + str(message[brightness_value_template])
-                                + "'"
+                        payload = template.render(message)
+                        if payload is not None:
+                            logger.debug(
+                                "updateSwitch: message[brightness_value_template]: '%s'",
+                                payload,
                             )
-                            payload = message[brightness_value_template]
-                            brightness_scale = 255
-                            if "brightness_scale" in configdict:
-                                brightness_scale = configdict["brightness_scale"]
-                            sValue = payload * 100 / brightness_scale
+                            sValue = payload * 100 / descriptor.brightness_scale
                         else:
-                            Domoticz.Debug(
+                            logger.debug(
                                 "updateSwitch: message[brightness_value_template]: '-'"
                             )
                     else:
-                        Domoticz.Debug(
-                            "updateSwitch: unsupported template: '"
-                            + configdict["brightness_value_template"]
-                            + "'"
+                        logger.debug(
+                            "updateSwitch: unsupported template: '%s'",
+                            template.template,
                         )
                 else:
                     payload = int(message)
-                    brightness_scale = 255
-                    if "brightness_scale" in configdict:
-                        brightness_scale = configdict["brightness_scale"]
-                    sValue = int(payload * 100 / brightness_scale)
-                    Domoticz.Debug("updateSwitch: sValue: '" + str(sValue) + "'")
+                    sValue = int(payload * 100 / descriptor.brightness_scale)
+                    logger.debug("updateSwitch: sValue: '%s'", sValue)
                     updatedevice = True
 
-            if "position_topic" in devicetopics:
+            if "position_topic" in roles:
                 payload = message
                 sValue = payload
                 nValue = 0
-                Domoticz.Log("updateSwitch: sValue: '" + str(sValue) + "'")
+                logger.event(
+                    "updates",
+                    "devices",
+                    descriptor.unit,
+                    "updateSwitch: sValue: '%s'",
+                    sValue,
+                )
                 updatedevice = True
 
-            if "rgb_state_topic" in devicetopics:
-                Domoticz.Debug("updateSwitch: Got rgb_state_topic")
-                if "rgb_value_template" in configdict:
-                    m = re.match(
-                        r"^{{value_json\.(.+)}}$", configdict["rgb_value_template"]
-                    )
-                    if m:
-                        rgb_value_template = m.group(1)
-                        Domoticz.Debug(
-                            "updateSwitch: rgb_value_template: '"
-                            + rgb_value_template
-                            + "'"
+            if "rgb_state_topic" in roles:
+                logger.debug("updateSwitch: Got rgb_state_topic")
+                if descriptor.rgb_value_template is not None:
+                    template = descriptor.rgb_value_template
+                    if template.valid:
+                        logger.debug(
+                            "updateSwitch: rgb_value_template: '%s'", template.template
                         )
-                        if rgb_value_template in message:
-                            Domoticz.Debug(
-                                "updateSwitch: message[rgb_value_template]: '"
-                                + str(message[rgb_value_template])
-                                + "'"
+                        payload = template.render(message)
+                        if payload is not None:
+                            logger.debug(
+                                "updateSwitch: message[rgb_value_template]: '%s'",
+                                payload,
                             )
-                            payload = message[rgb_value_template]
                             if (
                                 len(payload) == 6
                                 or len(payload) == 8
@@ -1557,18 +2966,18 @@ class BasePlugin:
                                 Color["b"] = int(payload[4:6], 16)
                                 Color["cw"] = 0
                                 Color["ww"] = 0
-                                Domoticz.Debug(
-                                    "updateSwitch: Color: " + json.dumps(Color)
+                                logger.debug(
+                                    "updateSwitch: Color: %s",
+                                    LazyStr(json.dumps, Color),
                                 )
                         else:
-                            Domoticz.Debug(
+                            logger.debug(
                                 "updateSwitch: message[rgb_value_template]: '-'"
                             )
                     else:
-                        Domoticz.Debug(
-                            "updateSwitch: unsupported template: '"
-                            + configdict["rgb_value_template"]
-                            + "'"
+                        logger.debug(
+                            "updateSwitch: unsupported template: '%s'",
+                            template.template,
                         )
                 else:
                     # TODO: test
@@ -1577,41 +2986,36 @@ class BasePlugin:
                     # if "brightness_scale" in configdict:
                     #    brightness_scale = configdict['brightness_scale']
                     # sValue = payload * 100 / brightness_scale
-                    Domoticz.Debug("updateSwitch: sValue: '" + str(sValue) + "'")
-            elif "color_temp_state_topic" in devicetopics:
-                Domoticz.Debug("updateSwitch: Got color_temp_state_topic")
-                if "color_temp_value_template" in configdict:
-                    m = re.match(
-                        r"^{{value_json\.(.+)}}$",
-                        configdict["color_temp_value_template"],
-                    )
-                    if m:
-                        color_temp_value_template = m.group(1)
-                        Domoticz.Debug(
-                            "updateSwitch: color_temp_value_template: '"
-                            + color_temp_value_template
-                            + "'"
+                    logger.debug("updateSwitch: sValue: '%s'", sValue)
+            elif "color_temp_state_topic" in roles:
+                logger.debug("updateSwitch: Got color_temp_state_topic")
+                if descriptor.color_temp_value_template is not None:
+                    template = descriptor.color_temp_value_template
+                    if template.valid:
+                        logger.debug(
+                            "updateSwitch: color_temp_value_template: '%s'",
+                            template.template,
                         )
-                        if color_temp_value_template in message:
-                            Domoticz.Debug(
-                                "updateSwitch: message[color_temp_value_template]: '"
-                                + str(message[color_temp_value_template])
-                                + "'"
+                        payload = template.render(message)
+                        if payload is not None:
+                            logger.debug(
+                                "updateSwitch: message[color_temp_value_template]: '%s'",
+                                payload,
                             )
-                            payload = message[color_temp_value_template]
                             updatecolor = True
                             Color["m"] = 2  # Color temperature
                             Color["t"] = int(255 * (int(payload) - 153) / (500 - 153))
-                            Domoticz.Debug("updateSwitch: Color: " + json.dumps(Color))
+                            logger.debug(
+                                "updateSwitch: Color: %s", LazyStr(json.dumps, Color)
+                            )
                         else:
-                            Domoticz.Debug(
+                            logger.debug(
                                 "updateSwitch: message[color_temp_value_template]: '-'"
                             )
                     else:
-                        Domoticz.Debug(
-                            "updateSwitch: unsupported template: '"
-                            + configdict["color_temp_value_template"]
-                            + "'"
+                        logger.debug(
+                            "updateSwitch: unsupported template: '%s'",
+                            template.template,
                         )
                 else:
                     # TODO: test
@@ -1620,157 +3024,113 @@ class BasePlugin:
                     # if "brightness_scale" in configdict:
                     #    brightness_scale = configdict['brightness_scale']
                     # sValue = payload * 100 / brightness_scale
-                    Domoticz.Debug("updateSwitch: sValue: '" + str(sValue) + "'")
-        except (ValueError, KeyError) as e:
+                    logger.debug("updateSwitch: sValue: '%s'", sValue)
+        except (ValueError, KeyError, TypeError) as e:
             pass
 
         if updatedevice:
             if updatecolor:
                 # Do not update if we got Tasmota periodic state update and state has not changed
-                if (
-                    not isTeleTopic
-                    or nValue != device.nValue
-                    or sValue != device.sValue
+                if not isTeleTopic or (nValue, str(sValue)) != self.getLatestValues(
+                    descriptor.unit, device
                 ):
-                    Domoticz.Log(
-                        self.deviceStr(self.getUnit(device))
-                        + ": Topic: '"
-                        + str(topic)
-                        + " 'Setting nValue: "
-                        + str(device.nValue)
-                        + "->"
-                        + str(nValue)
-                        + ", sValue: '"
-                        + str(device.sValue)
-                        + "'->'"
-                        + str(sValue)
-                        + "', color: '"
-                        + device.Color
-                        + "'->'"
-                        + json.dumps(Color)
-                        + "'"
+                    logger.event(
+                        "updates",
+                        "devices",
+                        descriptor.unit,
+                        "%s: Topic: '%s 'Setting nValue: %s->%s, sValue: '%s'->'%s', color: '%s'->'%s'",
+                        LazyStr(self.deviceStr, descriptor.unit),
+                        topic,
+                        device.nValue,
+                        nValue,
+                        device.sValue,
+                        sValue,
+                        device.Color,
+                        LazyStr(json.dumps, Color),
                     )
-                    device.Update(
-                        nValue=nValue, sValue=str(sValue), Color=json.dumps(Color)
+                    self.queueUpdate(
+                        descriptor.unit,
+                        False,
+                        nValue=nValue,
+                        sValue=str(sValue),
+                        Color=json.dumps(Color),
                     )
-                    self.copyDevices()
+                    self.scheduleTimeout(descriptor.unit, time.time())
             else:
                 # Do not update if we got Tasmota periodic state update and state has not changed
-                if (
-                    not isTeleTopic
-                    or nValue != device.nValue
-                    or sValue != device.sValue
+                if not isTeleTopic or (nValue, str(sValue)) != self.getLatestValues(
+                    descriptor.unit, device
                 ):
-                    Domoticz.Log(
-                        self.deviceStr(self.getUnit(device))
-                        + ": Topic: '"
-                        + str(topic)
-                        + " 'Setting nValue: "
-                        + str(device.nValue)
-                        + "->"
-                        + str(nValue)
-                        + ", sValue: '"
-                        + str(device.sValue)
-                        + "'->'"
-                        + str(sValue)
-                        + "'"
+                    logger.event(
+                        "updates",
+                        "devices",
+                        descriptor.unit,
+                        "%s: Topic: '%s 'Setting nValue: %s->%s, sValue: '%s'->'%s'",
+                        LazyStr(self.deviceStr, descriptor.unit),
+                        topic,
+                        device.nValue,
+                        nValue,
+                        device.sValue,
+                        sValue,
                     )
-                    device.Update(nValue=nValue, sValue=str(sValue))
-                    self.copyDevices()
+                    self.queueUpdate(
+                        descriptor.unit, False, nValue=nValue, sValue=str(sValue)
+                    )
+                    self.scheduleTimeout(descriptor.unit, time.time())
 
-    def updateAvailability(self, device, topic, message):
+    def updateAvailability(self, device, descriptor, topic, roles, message):
         TimedOut = 0
         updatedevice = False
 
-        try:
-            devicetopics = []
-            configdict = json.loads(device.Options["config"])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
-            if "availability_topic" in devicetopics:
-                Domoticz.Debug("updateAvailability: Got availability_topic")
-                if "availability_template" in configdict:
-                    m = re.match(
-                        r"^{{value_json\.(.+)}}$", configdict["availability_template"]
-                    )
-                    availability_template = m.group(1)
-                    Domoticz.Debug(
-                        "updateAvailability: availability_template: '"
-                        + availability_template
-                        + "'"
+        if "availability_topic" in roles:
+            logger.debug("updateAvailability: Got availability_topic")
+            payload = message
+            if descriptor.availability_template is not None:
+                payload = descriptor.availability_template.render(message)
+                if payload is not None:
+                    logger.debug(
+                        "updateAvailability: message[availability_template]: '%s'",
+                        payload,
                     )
-                    if availability_template in message:
-                        Domoticz.Debug(
-                            "updateAvailability: message[availability_template]: '"
-                            + message[availability_template]
-                            + "'"
-                        )
-                        payload = message[availability_template]
-                        if payload == configdict["payload_available"]:
-                            updatedevice = True
-                            TimedOut = 0
-                        if payload == configdict["payload_not_available"]:
-                            updatedevice = True
-                            TimedOut = 1
-                        Domoticz.Debug(
-                            "updateAvailability: TimedOut: '" + str(TimedOut) + "'"
-                        )
-                    else:
-                        Domoticz.Debug(
-                            "updateAvailability: message[availability_template]: '-'"
-                        )
                 else:
-                    payload = message
-                    if payload == configdict["payload_available"]:
-                        updatedevice = True
-                        TimedOut = 0
-                    if payload == configdict["payload_not_available"]:
-                        updatedevice = True
-                        TimedOut = 1
-                    Domoticz.Debug(
-                        "updateAvailability: TimedOut: '" + str(TimedOut) + "'"
+                    logger.debug(
+                        "updateAvailability: message[availability_template]: '-'"
                     )
-        except (ValueError, KeyError) as e:
-            pass
+            if payload is not None:
+                if payload == descriptor.payload_available:
+                    updatedevice = True
+                    TimedOut = 0
+                if payload == descriptor.payload_not_available:
+                    updatedevice = True
+                    TimedOut = 1
+                logger.debug("updateAvailability: TimedOut: '%s'", TimedOut)
 
         if updatedevice:
-            nValue = device.nValue
-            sValue = device.sValue
-            Domoticz.Log(
-                self.deviceStr(self.getUnit(device))
-                + ": Setting TimedOut: '"
-                + str(TimedOut)
-                + "'"
-            )
-            device.Update(
-                nValue=nValue, sValue=sValue, TimedOut=TimedOut, SuppressTriggers=True
+            logger.event(
+                "availability changes",
+                "devices",
+                descriptor.unit,
+                "%s: Setting TimedOut: '%s'",
+                LazyStr(self.deviceStr, descriptor.unit),
+                TimedOut,
             )
-            self.copyDevices()
+            self.queueUpdate(descriptor.unit, True, TimedOut=TimedOut)
 
-    def updateTasmotaStatus(self, device, topic, message):
+    def updateTasmotaStatus(self, device, descriptor, topic, roles, message):
         # Domoticz.Debug("updateTasmotaStatus topic: '" + topic + "' message: '" + str(message) + "'")
-        nValue = device.nValue
-        sValue = device.sValue
         updatedevice = False
         Vcc = 0
         RSSI = 0
 
-        try:
-            devicetopics = []
-            configdict = json.loads(device.Options["config"])
-            for key, value in configdict.items():
-                if value == topic:
-                    devicetopics.append(key)
-            if "tasmota_tele_topic" in devicetopics:
-                Domoticz.Debug("updateAvailability: Got tasmota_tele_topic")
+        if "tasmota_tele_topic" in roles and isinstance(message, dict):
+            logger.debug("updateAvailability: Got tasmota_tele_topic")
+            try:
                 if "Vcc" in message and self.options["updateVCC"]:
                     Vcc = int(message["Vcc"] * 10)
-                    Domoticz.Debug(
-                        "updateAvailability: Set battery level to: "
-                        + str(Vcc)
-                        + " was:"
-                        + str(device.BatteryLevel)
+                    logger.debug(
+                        "updateAvailability: Set battery level to: %s was:%s",
+                        Vcc,
+                        device.BatteryLevel,
                     )
                     updatedevice = True
                 if (
@@ -1779,85 +3139,58 @@ class BasePlugin:
                     and self.options["updateRSSI"]
                 ):
                     RSSI = int(message["Wifi"]["RSSI"])
-                    Domoticz.Debug(
-                        "updateAvailability: Set SignalLevel to: "
-                        + str(RSSI)
-                        + " was:"
-                        + str(device.SignalLevel)
+                    logger.debug(
+                        "updateAvailability: Set SignalLevel to: %s was:%s",
+                        RSSI,
+                        device.SignalLevel,
                     )
                     updatedevice = True
-            if updatedevice and (
-                device.SignalLevel != RSSI or device.BatteryLevel != Vcc
-            ):
-                Domoticz.Log(
-                    self.deviceStr(self.getUnit(device))
-                    + ": Setting SignalLevel: '"
-                    + str(RSSI)
-                    + "', BatteryLevel: '"
-                    + str(Vcc)
-                    + "'"
-                )
-                device.Update(
-                    nValue=nValue,
-                    sValue=sValue,
-                    SignalLevel=RSSI,
-                    BatteryLevel=Vcc,
-                    SuppressTriggers=True,
-                )
-                self.copyDevices()
-        except (ValueError, KeyError) as e:
-            pass
-
-    def updateTasmotaSettings(self, device, topic, message):
-        Domoticz.Debug(
-            "updateTasmotaSettings "
-            + self.deviceStr(self.getUnit(device))
-            + " topic: '"
-            + topic
-            + "' message: '"
-            + str(message)
-            + "'"
+            except (ValueError, TypeError) as e:
+                updatedevice = False
+        if updatedevice and (device.SignalLevel != RSSI or device.BatteryLevel != Vcc):
+            logger.event(
+                "updates",
+                "devices",
+                descriptor.unit,
+                "%s: Setting SignalLevel: '%s', BatteryLevel: '%s'",
+                LazyStr(self.deviceStr, descriptor.unit),
+                RSSI,
+                Vcc,
+            )
+            self.queueUpdate(descriptor.unit, True, SignalLevel=RSSI, BatteryLevel=Vcc)
+
+    def updateTasmotaSettings(self, device, descriptor, topic, message):
+        logger.debug(
+            "updateTasmotaSettings %s topic: '%s' message: '%s'",
+            LazyStr(self.deviceStr, descriptor.unit),
+            topic,
+            message,
         )
-        nValue = device.nValue
-        sValue = device.sValue
         updatedevice = False
         IPAddress = ""
         Description = ""
 
-        try:
-            devicetopics = []
-            configdict = json.loads(device.Options["config"])
-            if topic.endswith("STATUS5"):
-                if "StatusNET" in message and "IPAddress" in message["StatusNET"]:
-                    IPAddress = message["StatusNET"]["IPAddress"]
-                    cmnd_topic = re.sub(
-                        r"^tele\/", "cmnd/", configdict["tasmota_tele_topic"]
-                    )  # Replace tele with cmnd
-                    cmnd_topic = re.sub(
-                        r"\/tele\/", "/cmnd/", cmnd_topic
-                    )  # Replace tele with cmnd
-                    cmnd_topic = re.sub(
-                        r"\/STATE\d?", "", cmnd_topic
-                    )  # Remove '/STATE'
-                    Description = "IP: " + IPAddress + ", Topic: " + cmnd_topic
-                    updatedevice = True
-            if updatedevice and (device.Description != Description):
-                Domoticz.Log(
-                    "updateTasmotaSettings updating description from: '"
-                    + device.Description
-                    + "' to: '"
-                    + Description
-                    + "'"
-                )
-                device.Update(
-                    nValue=nValue,
-                    sValue=sValue,
-                    Description=Description,
-                    SuppressTriggers=True,
-                )
-                self.copyDevices()
-        except (ValueError, KeyError) as e:
-            pass
+        if (
+            topic.endswith("STATUS5")
+            and descriptor.tasmota is not None
+            and isinstance(message, dict)
+            and isinstance(message.get("StatusNET"), dict)
+            and "IPAddress" in message["StatusNET"]
+        ):
+            IPAddress = str(message["StatusNET"]["IPAddress"])
+            Description = (
+                "IP: " + IPAddress + ", Topic: " + descriptor.tasmota.cmndTopic
+            )
+            updatedevice = True
+        if updatedevice and (device.Description != Description):
+            Domoticz.Log(
+                "updateTasmotaSettings updating description from: '"
+                + device.Description
+                + "' to: '"
+                + Description
+                + "'"
+            )
+            self.queueUpdate(descriptor.unit, True, Description=Description)
 
 
 global _plugin
@@ -1869,6 +3202,11 @@ def onStart():
     _plugin.onStart()
 
 
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
+
 def onConnect(Connection, Status, Description):
     global _plugin
     _plugin.onConnect(Connection, Status, Description)